@@ -0,0 +1,153 @@
+"""Concurrency check and benchmark for boost spending and referral credit.
+
+Fires concurrent REFILL taps and /start referrals at a scratch database and
+checks that no boost is spent twice and no referral credited twice, both for
+the atomic statements the bot runs and for the old read-then-write version
+(which is expected to fail the check). Also checks that a REFILL repeated
+with the same idempotency key spends one boost however often it arrives.
+Then times the versions:
+
+    DATABASE_URL=postgresql://localhost/bert_bench python bench_boosts.py
+
+WARNING: this deletes rows from `referrals` and `boost_spends` - never point it at the
+production database.
+"""
+import os
+import asyncio
+import logging
+import argparse
+
+os.environ.setdefault('BOT_TOKEN', 'bench')
+os.environ.setdefault('DB_POOL_MAX_SIZE', '20')
+
+import bot
+from bench_common import timed
+
+logging.getLogger('bot').setLevel(logging.WARNING)
+
+USER = 424242
+REFERRER = 434343
+
+
+async def naive_spend_boost(uid):
+    """The previous use_boost: SELECT, then UPDATE in the same transaction"""
+    async with bot.db_pool.connection() as conn:
+        cur = await conn.execute("SELECT energy_boosts FROM referrals WHERE user_id = %s", (uid,))
+        result = await cur.fetchone()
+        boosts = result[0] if result else 0
+        if boosts > 0:
+            await conn.execute("""
+                UPDATE referrals SET energy_boosts = energy_boosts - 1 WHERE user_id = %s
+            """, (uid,))
+    return boosts - 1 if boosts > 0 else None
+
+
+async def naive_credit_referral(uid, referrer_id):
+    """The previous /start referral path: SELECT, INSERT, upsert, commit"""
+    async with bot.db_pool.connection() as conn:
+        cur = await conn.execute("SELECT user_id FROM referrals WHERE user_id = %s", (uid,))
+        if await cur.fetchone():
+            return False
+        await conn.execute("""
+            INSERT INTO referrals (user_id, referred_by, energy_boosts) VALUES (%s, %s, 0)
+        """, (uid, referrer_id))
+        await conn.execute("""
+            INSERT INTO referrals (user_id, energy_boosts, total_referrals) VALUES (%s, 1, 1)
+            ON CONFLICT (user_id) DO UPDATE
+            SET energy_boosts = referrals.energy_boosts + 1,
+                total_referrals = referrals.total_referrals + 1
+        """, (referrer_id,))
+        await conn.commit()
+    return True
+
+
+async def reset(boosts):
+    await bot.db_execute("DELETE FROM referrals WHERE user_id IN (%s, %s)", (USER, REFERRER))
+    await bot.db_execute("INSERT INTO referrals (user_id, energy_boosts) VALUES (%s, %s)", (REFERRER, boosts))
+
+
+async def check_spend(spend, boosts, taps):
+    await reset(boosts)
+    results = await asyncio.gather(*(spend(REFERRER) for _ in range(taps)), return_exceptions=True)
+    granted = sum(1 for r in results if isinstance(r, int))
+    left, = await bot.db_fetchone("SELECT energy_boosts FROM referrals WHERE user_id = %s", (REFERRER,))
+    ok = granted == boosts and left == 0
+    print(f"  {spend.__name__:<22} {taps} taps on {boosts} boosts: {granted} granted, "
+          f"{left} left -> {'OK' if ok else 'DOUBLE SPEND'}")
+    return ok
+
+
+async def check_repeat(boosts, taps, key):
+    """`taps` concurrent REFILLs with one key, as a client retrying a lost request"""
+    await reset(boosts)
+    await bot.db_execute("DELETE FROM boost_spends WHERE user_id = %s", (REFERRER,))
+    results = await asyncio.gather(*(bot.spend_boost_once(REFERRER, key) for _ in range(taps)))
+    claimed = sum(1 for c, _ in results if c)
+    left, = await bot.db_fetchone("SELECT energy_boosts FROM referrals WHERE user_id = %s", (REFERRER,))
+    ok = claimed == 1 and left == boosts - 1
+    print(f"  spend_boost_once       {taps} taps with one key on {boosts} boosts: {claimed} spent, "
+          f"{left} left -> {'OK' if ok else 'FAIL'}")
+    return ok
+
+
+async def check_referral(credit, starts):
+    await reset(0)
+    results = await asyncio.gather(*(credit(USER, REFERRER) for _ in range(starts)), return_exceptions=True)
+    credited = sum(1 for r in results if r is True)
+    errors = sum(1 for r in results if isinstance(r, Exception))
+    total, = await bot.db_fetchone("SELECT total_referrals FROM referrals WHERE user_id = %s", (REFERRER,))
+    ok = credited == 1 and total == 1 and not errors
+    print(f"  {credit.__name__:<22} {starts} concurrent /start: {credited} credited, total_referrals "
+          f"{total}, {errors} error(s) -> {'OK' if ok else 'FAIL'}")
+    return ok
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--taps', type=int, default=50, help="concurrent REFILL taps")
+    parser.add_argument('--boosts', type=int, default=3)
+    parser.add_argument('--rounds', type=int, default=20, help="repeat each concurrency check")
+    parser.add_argument('--repeat', type=int, default=500)
+    args = parser.parse_args()
+
+    bot.db_pool = bot.create_db_pool()
+    await bot.db_pool.open(wait=True)
+    try:
+        await bot.init_db()
+        failures = {}
+        print("Concurrent REFILL taps:")
+        for spend in (bot.spend_boost, naive_spend_boost):
+            results = [await check_spend(spend, args.boosts, args.taps) for _ in range(args.rounds)]
+            failures[spend.__name__] = results.count(False)
+        print("Repeated REFILL (same idempotency key):")
+        results = [await check_repeat(args.boosts, args.taps, f"retry-{i}") for i in range(args.rounds)]
+        failures['spend_boost_once'] = results.count(False)
+        print("Concurrent /start ref_<id> for one new user:")
+        for credit in (bot.credit_referral, naive_credit_referral):
+            results = [await check_referral(credit, args.taps) for _ in range(args.rounds)]
+            failures[credit.__name__] = results.count(False)
+
+        print("Latency (one request at a time):")
+        await reset(10 ** 9)
+        await timed("use_boost, atomic UPDATE ... RETURNING", lambda: bot.spend_boost(REFERRER), args.repeat)
+        await timed("use_boost, SELECT then UPDATE (old)", lambda: naive_spend_boost(REFERRER), args.repeat)
+        keys = (f"k{i}" for i in range(10 ** 9))
+        await timed("use_boost with a new key (claim + UPDATE CTE)",
+                    lambda: bot.spend_boost_once(REFERRER, next(keys)), args.repeat)
+        await timed("use_boost with a repeated key", lambda: bot.spend_boost_once(REFERRER, "k0"), args.repeat)
+        await bot.db_execute("DELETE FROM boost_spends WHERE user_id = %s", (REFERRER,))
+        uids = iter(range(10 ** 7, 10 ** 8))
+        await timed("referral credit, single CTE", lambda: bot.credit_referral(next(uids), REFERRER), args.repeat)
+        await timed("referral credit, SELECT + INSERT + upsert (old)",
+                    lambda: naive_credit_referral(next(uids), REFERRER), args.repeat)
+        await bot.db_execute("DELETE FROM referrals WHERE user_id >= %s", (10 ** 7,))
+
+        print("Failed rounds: " + ", ".join(f"{name} {count}/{args.rounds}" for name, count in failures.items()))
+        if failures['spend_boost'] or failures['spend_boost_once'] or failures['credit_referral']:
+            raise SystemExit("❌ atomic statements failed the concurrency check")
+    finally:
+        await bot.db_pool.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
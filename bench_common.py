@@ -0,0 +1,34 @@
+"""Timing helpers shared by the bench_*.py scripts."""
+import time
+import asyncio
+import statistics
+
+
+def report(label, samples, unit, width=44, digits=3):
+    """Print the median and p95 of `samples` (already in `unit`)"""
+    samples = sorted(samples)
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    print(f"  {label:<{width}} median {statistics.median(samples):8.{digits}f} {unit}   "
+          f"p95 {p95:8.{digits}f} {unit}")
+
+
+async def timed(label, fn, repeat, width=48):
+    """Call `fn` `repeat` times (awaiting it if it returns a coroutine) and report in ms"""
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        if asyncio.iscoroutine(result):
+            await result
+        samples.append((time.perf_counter() - t0) * 1000)
+    report(label, samples, "ms", width)
+
+
+def timed_sync(label, fn, repeat, width=30):
+    """Call `fn` `repeat` times and report in microseconds, for pure-Python work"""
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1e6)
+    report(label, samples, "us", width, digits=1)
@@ -0,0 +1,104 @@
+"""Benchmark for /rank and paginated /leaderboard at large player counts.
+
+Seeds the `leaderboard` table of a scratch database with synthetic players
+and times the queries the bot runs against the naive alternatives:
+
+    DATABASE_URL=postgresql://localhost/bert_bench python bench_leaderboard.py --players 1000000
+
+WARNING: this replaces every row in `leaderboard` - never point it at the
+production database.
+"""
+import os
+import time
+import logging
+import asyncio
+import argparse
+
+os.environ.setdefault('BOT_TOKEN', 'bench')
+
+import bot
+from bench_common import timed
+
+logging.getLogger('bot').setLevel(logging.WARNING)
+
+
+async def seed(players):
+    print(f"Seeding {players:,} players...")
+    t0 = time.perf_counter()
+    async with bot.db_pool.connection() as conn:
+        await conn.execute("DELETE FROM leaderboard")
+        # Heavy-tailed scores: most players low, a few near the 10M cap
+        await conn.execute("""
+            INSERT INTO leaderboard (id, name, score, season)
+            SELECT g, 'player' || g, (exp(random() * 16) - 1)::int, %s
+            FROM generate_series(1, %s) g
+        """, (bot.current_season, players))
+    async with bot.db_pool.connection() as conn:
+        await conn.set_autocommit(True)
+        await conn.execute("VACUUM ANALYZE leaderboard")
+    print(f"  done in {time.perf_counter() - t0:.1f}s")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--players', type=int, default=1_000_000)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--no-seed', action='store_true', help="reuse the rows already in the table")
+    args = parser.parse_args()
+
+    bot.db_pool = bot.create_db_pool()
+    await bot.db_pool.open(wait=True)
+    try:
+        await bot.init_db()
+        if not args.no_seed:
+            await seed(args.players)
+
+        rows = await bot.db_fetchall("""
+            SELECT id, score FROM leaderboard
+            WHERE id IN (
+                (SELECT id FROM leaderboard ORDER BY score DESC, id DESC LIMIT 1),
+                (SELECT id FROM leaderboard ORDER BY score DESC, id DESC OFFSET (SELECT count(*) / 2 FROM leaderboard) LIMIT 1),
+                (SELECT id FROM leaderboard ORDER BY score, id LIMIT 1)
+            )
+            ORDER BY score DESC
+        """)
+        targets = list(zip(("top player", "median player", "last player"), rows))
+        deep_page = 1000
+        deep = await bot.db_fetchone("""
+            SELECT score, id FROM leaderboard ORDER BY score DESC, id DESC
+            OFFSET %s LIMIT 1
+        """, ((deep_page - 1) * bot.LEADERBOARD_SIZE - 1,))
+
+        print("Top 10:")
+        await timed("leaderboard cache reload (top-K)", _reload_cache, args.repeat)
+        await timed("rendered top 10 from cache", _cached_text, args.repeat)
+
+        print("Personal rank (/rank):")
+        for label, (uid, score) in targets:
+            await timed(f"{label} via score buckets", lambda uid=uid: bot.get_player_rank(uid), args.repeat)
+            await timed(f"{label} via COUNT(*) (naive)", lambda score=score: bot.db_fetchone(
+                "SELECT count(*) + 1 FROM leaderboard WHERE season = %s AND score > %s",
+                (bot.current_season, score)), max(5, args.repeat // 10))
+
+        print(f"Page {deep_page} of /leaderboard:")
+        await timed("keyset cursor", lambda: bot.get_leaderboard_page(deep), args.repeat)
+        await timed("OFFSET (naive)", lambda: bot.db_fetchall("""
+            SELECT id, name, score FROM leaderboard WHERE season = %s
+            ORDER BY score DESC, id DESC OFFSET %s LIMIT %s
+        """, (bot.current_season, (deep_page - 1) * bot.LEADERBOARD_SIZE, bot.LEADERBOARD_SIZE)),
+            max(5, args.repeat // 10))
+    finally:
+        await bot.db_pool.close()
+
+
+async def _reload_cache():
+    bot.leaderboard_cache.invalidate()
+    await bot.leaderboard_cache.load()
+
+
+async def _cached_text():
+    return await bot.get_rank()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
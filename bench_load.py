@@ -0,0 +1,531 @@
+"""Load test: replay synthetic Telegram updates through the webhook.
+
+Starts the bot's real webhook server against a local PostgreSQL database
+and an in-process stub of the Bot API, POSTs generated updates to it and
+reports throughput, latency percentiles, SQL statements and Bot API calls
+per scenario:
+
+    DATABASE_URL=postgresql://localhost/bert_bench python bench_load.py --updates 5000 --clients 50
+
+Latency is measured from the POST until the update's handler has finished;
+replies go out through the bot's send queue afterwards, and the time until
+the last one is delivered is reported separately. Send limits are lifted
+unless --flood is given, which keeps them and makes the stub answer like
+Telegram's flood control (429 + retry_after) when they are exceeded:
+
+    python bench_load.py --scenario broadcast --players 3000 --flood
+
+--concurrency takes a list of update-concurrency settings and replays the
+same updates at each, ending with a throughput table; --db-latency adds a
+simulated network round trip to every SQL statement, as with a remote
+database:
+
+    python bench_load.py --concurrency 1,4,16,64 --db-latency 2
+
+--workers runs the bot as that many separate processes in multi-worker
+mode (WORKERS=n), each with its own webhook port, and spreads the updates
+across them the way a load balancer would; it also takes a list:
+
+    python bench_load.py --scenario sync --workers 1,2,4 --unthrottled
+
+--log-level INFO keeps the bot's own logging on, so the LOG_* settings can
+be compared (logs go to stderr):
+
+    LOG_ASYNC=0 LOG_SAMPLE_RATE=1 python bench_load.py --scenario mixed --log-level INFO 2>/dev/null
+
+--redeliver posts that fraction of updates a second time, as Telegram does
+when a webhook response is lost, and reports how many were handled twice
+(none should be):
+
+    python bench_load.py --scenario mixed --redeliver 0.1
+
+Runs are seeded, so the same arguments replay the same updates.
+
+WARNING: this truncates the bot's tables - never point it at the production
+database.
+"""
+import os
+import sys
+import json
+import signal
+import time
+import random
+import asyncio
+import logging
+import argparse
+from collections import Counter, deque
+
+os.environ.setdefault('BOT_TOKEN', '123456:bench')
+
+import httpx
+import numpy as np
+import tornado.web
+import tornado.httpserver
+from telegram import Update
+from telegram.ext import TypeHandler
+
+import bot
+from bench_taps import encode_taps, human_taps
+
+TOKEN = os.environ['BOT_TOKEN']
+WEBHOOK_PORT = 18443
+STUB_PORT = 18081
+ADMIN_ID = 999
+
+SCENARIOS = {
+    # name: [(kind, weight)]
+    'start': [('start', 0.7), ('start_ref', 0.3)],
+    'sync': [('sync', 1)],
+    'leaderboard': [('leaderboard', 1)],
+    'boosts': [('get_boosts', 0.5), ('use_boost', 0.5)],
+    'mixed': [('sync', 0.7), ('leaderboard', 0.1), ('start', 0.05), ('start_ref', 0.03),
+              ('get_boosts', 0.05), ('use_boost', 0.05), ('rank', 0.02)],
+    'broadcast': [('broadcast', 1)],  # a single admin /broadcast to every player
+}
+
+# Telegram's flood limits as the stub enforces them with --flood
+FLOOD_GLOBAL_PER_SECOND = 30
+FLOOD_CHAT_RATE, FLOOD_CHAT_BURST = 1.0, 3.0
+
+
+class Tracker:
+    """Send and completion times of one scenario's updates"""
+
+    def __init__(self):
+        self.reset(0)
+
+    def reset(self, expected):
+        self.expected = expected
+        self.sent_at, self.done_at = {}, {}
+        self.repeats = 0
+        self.finished = asyncio.Event()
+
+    def done(self, update_id):
+        if update_id in self.done_at:
+            self.repeats += 1
+        self.done_at[update_id] = time.perf_counter()
+        if len(self.done_at) >= self.expected:
+            self.finished.set()
+
+
+tracker = Tracker()
+redeliver_rng = random.Random(0)
+
+
+class DoneReport(tornado.web.RequestHandler):
+    """Completed update ids reported by worker processes"""
+
+    def post(self):
+        for update_id in json.loads(self.request.body):
+            tracker.done(update_id)
+
+
+class BotApiStub(tornado.web.RequestHandler):
+    """Answers every Bot API method with a minimal successful result"""
+
+    calls = Counter()
+    last_send = 0.0
+    latency = 0.0
+    flood = False
+    recent = deque()  # send times in the last second
+    chat_buckets = {}  # chat_id -> [tokens, last]
+
+    async def post(self, token, method):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.flood and method == 'sendMessage':
+            retry_after = self.flood_check(self.get_body_argument('chat_id', None))
+            if retry_after:
+                BotApiStub.calls['429'] += 1
+                self.set_status(429)
+                self.write({'ok': False, 'error_code': 429, 'parameters': {'retry_after': retry_after},
+                            'description': f'Too Many Requests: retry after {retry_after}'})
+                return
+        BotApiStub.calls[method] += 1
+        if method == 'sendMessage':
+            BotApiStub.last_send = time.perf_counter()
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bert', 'username': 'berttapbot'}
+        elif method in ('sendMessage', 'editMessageText', 'sendDocument'):
+            result = {'message_id': 1, 'date': int(time.time()), 'chat': {'id': 1, 'type': 'private'}}
+        else:
+            result = True
+        self.write({'ok': True, 'result': result})
+
+    get = post
+
+    @classmethod
+    def flood_check(cls, chat_id):
+        """Seconds to wait if this send breaks the flood limits, else 0"""
+        now = time.monotonic()
+        while cls.recent and now - cls.recent[0] > 1:
+            cls.recent.popleft()
+        if len(cls.recent) >= FLOOD_GLOBAL_PER_SECOND:
+            return 1
+        bucket = cls.chat_buckets.setdefault(chat_id, [FLOOD_CHAT_BURST, now])
+        bucket[0] = min(FLOOD_CHAT_BURST, bucket[0] + (now - bucket[1]) * FLOOD_CHAT_RATE)
+        bucket[1] = now
+        if bucket[0] < 0.9:  # a little slack for network jitter
+            return 1
+        bucket[0] -= 1
+        cls.recent.append(now)
+        return 0
+
+
+class Players:
+    """Deterministic synthetic player base with heavy-tailed scores"""
+
+    def __init__(self, count, rng):
+        self.rng = rng
+        self.tap_rng = np.random.default_rng(rng.getrandbits(32))
+        self.ids = [1_000_000 + i for i in range(count)]
+        self.scores = {uid: int(rng.lognormvariate(7, 1.5)) % bot.MAX_SCORE for uid in self.ids}
+        self.next_update = 1
+
+    def pick(self):
+        return self.rng.choice(self.ids)
+
+    def update(self, kind):
+        uid = self.pick()
+        update_id = self.next_update
+        self.next_update += 1
+        sender = {'id': uid, 'is_bot': False, 'first_name': f'P{uid % 100000}'}
+        message = {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': uid, 'type': 'private', 'first_name': sender['first_name']},
+            'from': sender,
+        }
+        if kind == 'broadcast':
+            sender['id'] = message['chat']['id'] = ADMIN_ID
+            message['text'] = '/broadcast 🎉 Season 2 starts tomorrow!'
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len('/broadcast')}]
+        elif kind in ('start', 'start_ref', 'leaderboard', 'rank'):
+            text = '/' + ('start' if kind.startswith('start') else kind)
+            command_length = len(text)
+            if kind == 'start_ref':
+                text += f' ref_{self.pick()}'
+            message['text'] = text
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': command_length}]
+        else:
+            if kind == 'sync':
+                # Realistic growth between syncs, well under the score-rate limit
+                gained = self.rng.randint(0, 2000)
+                self.scores[uid] = min(bot.MAX_SCORE, self.scores[uid] + gained)
+                data = {'score': self.scores[uid], 'totalTaps': self.scores[uid], 'flagged': False,
+                        'suspiciousCount': 0, 'energy': self.rng.randint(0, bot.BASE_ENERGY),
+                        'buys': ['tap'] if self.rng.random() < 0.05 else [],
+                        'taps': encode_taps(*human_taps(self.tap_rng, min(gained, 700)))}
+                # What the game owns, buys included (the bot seeds a new player's state from it)
+                data.update(levels=[1 + len(data['buys']), 1, 1], cards=0)
+            else:
+                data = {'action': kind}
+                if kind == 'use_boost':
+                    data['key'] = f'{update_id:x}'
+            message['web_app_data'] = {'data': json.dumps(data), 'button_text': '🕹️ PLAY BERT'}
+        return update_id, {'update_id': update_id, 'message': message}
+
+
+class SlowCursor(bot.TimedCursor):
+    """Adds a fixed delay to every statement, standing in for network latency"""
+
+    delay = 0.0
+
+    async def execute(self, query, params=None, **kwargs):
+        await asyncio.sleep(self.delay)
+        return await super().execute(query, params, **kwargs)
+
+
+def percentile(samples, p):
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def statement_counts():
+    counts = Counter()
+    for metric in bot.DB_QUERY_SECONDS.collect():
+        for sample in metric.samples:
+            if sample.name.endswith('_count'):
+                counts[sample.labels['statement']] += int(sample.value)
+    return counts
+
+
+async def wait_for_quiet(idle=1.0):
+    """Time of the last sendMessage once the stub has seen none for `idle` seconds"""
+    while time.perf_counter() - BotApiStub.last_send < idle:
+        await asyncio.sleep(0.1)
+    return BotApiStub.last_send
+
+
+async def run_scenario(name, players, args, client, ports, app=None):
+    """Replay one scenario; `app` is the in-process application, if any"""
+    kinds, weights = zip(*SCENARIOS[name])
+    updates = args.updates
+    if name == 'broadcast':
+        updates = 1
+        await seed_players(players)
+    batch = [players.update(kind) for kind in players.rng.choices(kinds, weights, k=updates)]
+    tracker.reset(len(batch))
+    db_before = statement_counts()
+    api_before = Counter(BotApiStub.calls)
+    shed_before = sum(bot.throttle.shed.values())
+    queue = asyncio.Queue()
+    redelivered = 0
+    for update_id, payload in batch:
+        queue.put_nowait((update_id, payload, 0))
+        if args.redeliver and redeliver_rng.random() < args.redeliver:
+            # With --workers the load balancer sends the retry to another worker
+            queue.put_nowait((update_id, payload, 1))
+            redelivered += 1
+
+    async def sender():
+        while not queue.empty():
+            update_id, payload, retry = queue.get_nowait()
+            port = ports[(update_id + retry) % len(ports)]
+            tracker.sent_at.setdefault(update_id, time.perf_counter())
+            response = await client.post(f'http://127.0.0.1:{port}/{TOKEN}', json=payload)
+            response.raise_for_status()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(sender() for _ in range(args.clients)))
+    await asyncio.wait_for(tracker.finished.wait(), timeout=300)
+    elapsed = time.perf_counter() - start
+    if app is not None:
+        if bot.broadcast_task is not None:
+            await bot.broadcast_task
+        await bot.send_queue.drain()
+        delivered = time.perf_counter() - start
+        await bot.score_buffer.flush()
+        await bot.cheater_queue.flush()
+    else:
+        delivered = await wait_for_quiet() - start
+
+    latencies = sorted((tracker.done_at[uid] - sent) * 1000 for uid, sent in tracker.sent_at.items())
+    result = (len(batch) / elapsed, percentile(latencies, .50), percentile(latencies, .99))
+    api = Counter(BotApiStub.calls) - api_before
+    print(f"\n[{name}] {len(batch)} updates in {elapsed:.2f}s -> {len(batch) / elapsed:,.0f} updates/s")
+    print(f"  latency ms: p50 {percentile(latencies, .50):.1f}  p95 {percentile(latencies, .95):.1f}"
+          f"  p99 {percentile(latencies, .99):.1f}  max {latencies[-1]:.1f}")
+    if app is not None:
+        db = statement_counts() - db_before
+        print(f"  SQL statements: {sum(db.values()):,} ({sum(db.values()) / len(batch):.2f}/update)"
+              f"  throttled: {sum(bot.throttle.shed.values()) - shed_before:,}")
+        for label, count in db.most_common(6):
+            print(f"    {count:>7,}  {label}")
+    if redelivered:
+        await asyncio.sleep(0.2)  # a repeat handled after the last first delivery
+        print(f"  redelivered: {redelivered:,}  handled twice: {tracker.repeats:,}")
+    print("  Bot API calls: " + ", ".join(f"{m} {c:,}" for m, c in api.most_common()))
+    print(f"  all replies delivered after {delivered:.2f}s"
+          f" ({api['sendMessage'] / max(delivered, 1e-9):,.1f} messages/s)")
+    return result
+
+
+async def seed_players(players):
+    """Make sure every synthetic player is a broadcast recipient"""
+    async with bot.db_pool.connection() as conn:
+        await conn.execute("""
+            INSERT INTO leaderboard (id, name, score, season)
+            SELECT id, 'P' || id, 0, %s FROM unnest(%s::bigint[]) id
+            ON CONFLICT (id) DO NOTHING
+        """, (bot.current_season, players.ids))
+
+
+async def reset_tables():
+    async with bot.db_pool.connection() as conn:
+        await conn.execute("""
+            TRUNCATE leaderboard, referrals, cheaters, sync_sessions, score_buckets, leaderboard_archive,
+                throttle_buckets, player_state, processed_updates, boost_spends
+        """)
+    bot.leaderboard_cache.invalidate()
+    bot.referral_graph.invalidate()
+    await bot.referral_graph.load()
+    bot.session_tracker.sessions.clear()
+    bot.player_states.clear()
+    bot.update_dedup.clear()  # update_ids restart at 1 on every replay
+    for buckets in bot.throttle.buckets.values():
+        buckets.clear()
+
+
+def build_app(concurrency, args):
+    bot.UPDATE_CONCURRENCY = concurrency
+    bot.db_pool = bot.create_db_pool()
+    bot.db_pool.kwargs['cursor_factory'] = SlowCursor
+    if not args.flood:
+        bot.send_queue = bot.SendQueue(1e9, 1e9, 1, bot.SEND_CONCURRENCY, bot.SEND_MAX_ATTEMPTS,
+                                       bot.BROADCAST_BUFFER, bot.SEND_CHAT_QUEUE)
+    return bot.build_application(TOKEN, base_url=f'http://127.0.0.1:{STUB_PORT}/bot')
+
+
+async def replay(args, ports, app=None):
+    players = Players(args.players, random.Random(args.seed))
+    names = list(SCENARIOS) if args.scenario == 'all' else [args.scenario]
+    results = {}
+    async with httpx.AsyncClient(limits=httpx.Limits(max_connections=args.clients)) as client:
+        for name in names:
+            results[name] = await run_scenario(name, players, args, client, ports, app)
+    return results
+
+
+async def run(concurrency, args):
+    """Replay every scenario against a fresh in-process application"""
+    app = build_app(concurrency, args)
+
+    async def on_done(update, context):
+        tracker.done(update.update_id)
+
+    app.add_handler(TypeHandler(Update, on_done), group=99)
+    async with app:
+        await bot.post_init(app)
+        await bot.startup.warm.wait()
+        await reset_tables()
+        await app.start()
+        await app.updater.start_webhook(listen='127.0.0.1', port=WEBHOOK_PORT, url_path=TOKEN)
+        try:
+            return await replay(args, [WEBHOOK_PORT], app)
+        finally:
+            await app.updater.stop()
+            await app.stop()
+            await bot.post_stop(app)
+            await bot.post_shutdown(app)
+
+
+async def run_workers(workers, concurrency, args):
+    """Replay every scenario against `workers` bot processes in multi-worker mode"""
+    bot.db_pool = bot.create_db_pool()
+    await bot.db_pool.open(wait=True)
+    await bot.init_db()
+    await reset_tables()
+    ports = [WEBHOOK_PORT + i for i in range(workers)]
+    passthrough = ['--concurrency', str(concurrency), '--db-latency', str(args.db_latency),
+                   '--log-level', args.log_level] + ['--flood'] * args.flood + ['--unthrottled'] * args.unthrottled
+    procs = []
+    try:
+        for port in ports:
+            proc = await asyncio.create_subprocess_exec(
+                sys.executable, __file__, '--serve', str(port), *passthrough,
+                env={**os.environ, 'WORKERS': str(workers)}, stdout=asyncio.subprocess.PIPE)
+            procs.append(proc)
+        for proc in procs:
+            while (await proc.stdout.readline()).strip() != b'READY':
+                pass
+        return await replay(args, ports)
+    finally:
+        for proc in procs:
+            proc.send_signal(signal.SIGTERM)
+        for proc in procs:
+            await proc.wait()
+        await bot.db_pool.close()
+
+
+async def serve(port, args):
+    """Worker process for --workers: serve the webhook until SIGTERM"""
+    app = build_app(args.concurrency[0], args)
+    done = []
+
+    async def report():
+        async with httpx.AsyncClient() as client:
+            while True:
+                await asyncio.sleep(0.02)
+                if done:
+                    batch = done[:]
+                    del done[:len(batch)]
+                    await client.post(f'http://127.0.0.1:{STUB_PORT}/bench/done', json=batch)
+
+    async def on_done(update, context):
+        done.append(update.update_id)
+
+    app.add_handler(TypeHandler(Update, on_done), group=99)
+    stopping = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+    async with app:
+        await bot.post_init(app)
+        await app.start()
+        await app.updater.start_webhook(listen='127.0.0.1', port=port, url_path=TOKEN)
+        reporter = asyncio.create_task(report())
+        print('READY', flush=True)
+        try:
+            await stopping.wait()
+        finally:
+            reporter.cancel()
+            await app.updater.stop()
+            await app.stop()
+            await bot.post_stop(app)
+            await bot.post_shutdown(app)
+
+
+def print_table(title, results):
+    print(f"\nupdates/s (p50 / p99 latency ms) by {title}:")
+    names = list(next(iter(results.values())))
+    print(f"  {'':<12}" + "".join(f"{c:>24}" for c in results))
+    for name in names:
+        cells = (f"{rate:,.0f} ({p50:,.0f} / {p99:,.0f})" for rate, p50, p99 in
+                 (results[c][name] for c in results))
+        print(f"  {name:<12}" + "".join(f"{cell:>24}" for cell in cells))
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',')]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', choices=list(SCENARIOS) + ['all'], default='all')
+    parser.add_argument('--updates', type=int, default=3000, help="updates per scenario")
+    parser.add_argument('--clients', type=int, default=50, help="concurrent webhook POSTs")
+    parser.add_argument('--players', type=int, default=2000)
+    parser.add_argument('--bot-latency', type=float, default=0.0, help="stub Bot API latency in ms")
+    parser.add_argument('--db-latency', type=float, default=0.0, help="extra latency per SQL statement in ms")
+    parser.add_argument('--concurrency', type=int_list, default=[bot.UPDATE_CONCURRENCY],
+                        help="update concurrency, e.g. 1,8,32")
+    parser.add_argument('--workers', type=int_list, default=None,
+                        help="run the bot as this many worker processes, e.g. 1,2,4")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--unthrottled', action='store_true', help="lift the per-user rate limits")
+    parser.add_argument('--flood', action='store_true',
+                        help="keep the bot's send limits and have the stub enforce Telegram's")
+    parser.add_argument('--redeliver', type=float, default=0.0,
+                        help="fraction of updates posted twice, like Telegram's webhook retries")
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(args.log_level)
+    logging.getLogger('bot').setLevel(args.log_level)
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    logging.getLogger('tornado.access').setLevel(logging.WARNING)  # the Bot API stub's
+    if args.unthrottled:
+        for action in bot.THROTTLE_LIMITS:
+            bot.THROTTLE_LIMITS[action] = (1e9, 1e9)
+    SlowCursor.delay = args.db_latency / 1000
+    bot.ADMIN_USER_IDS.append(ADMIN_ID)
+    bot.METRICS_PORT = 0
+    if args.serve:
+        await serve(args.serve, args)
+        return
+
+    BotApiStub.latency = args.bot_latency / 1000
+    BotApiStub.flood = args.flood
+    stub = tornado.httpserver.HTTPServer(tornado.web.Application([
+        (r"/bench/done", DoneReport),
+        (r"/bot([^/]+)/(\w+)", BotApiStub),
+    ]))
+    stub.listen(STUB_PORT, '127.0.0.1')
+
+    results = {}
+    if args.workers:
+        for workers in args.workers:
+            for concurrency in args.concurrency:
+                label = f"{workers}w x {concurrency}"
+                print(f"\n=== {workers} worker(s), update concurrency {concurrency} ===")
+                results[label] = await run_workers(workers, concurrency, args)
+    else:
+        for concurrency in args.concurrency:
+            print(f"\n=== update concurrency {concurrency} ===")
+            results[concurrency] = await run(concurrency, args)
+    stub.stop()
+    if len(results) > 1:
+        print_table("workers x update concurrency" if args.workers else "update concurrency", results)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,197 @@
+"""Check and benchmark for the in-memory referral graph.
+
+Seeds `referrals` (and `leaderboard`, for activity) of a scratch database
+with a synthetic referral forest plus a few referral farms, checks that the
+graph's top inviters, tree sizes and farm list match SQL, and times them
+against the SQL each would otherwise need:
+
+    DATABASE_URL=postgresql://localhost/bert_bench python bench_referrals.py --users 1000000
+
+WARNING: this replaces every row in `referrals` and `leaderboard` - never
+point it at the production database. Exits non-zero if a check fails.
+"""
+import os
+import sys
+import time
+import logging
+import asyncio
+import argparse
+
+os.environ.setdefault('BOT_TOKEN', 'bench')
+
+import bot
+from bench_common import timed
+
+logging.getLogger('bot').setLevel(logging.WARNING)
+
+FARM_SIZE = 200
+
+TREE_SQL = """
+    WITH RECURSIVE tree AS (
+        SELECT user_id, 1 AS level FROM referrals WHERE referred_by = %s
+        UNION ALL
+        SELECT r.user_id, t.level + 1 FROM referrals r JOIN tree t ON r.referred_by = t.user_id
+    )
+    SELECT count(*), coalesce(max(level), 0) FROM tree
+"""
+
+TOP_SQL = """
+    SELECT referred_by, count(*) FROM referrals WHERE referred_by IS NOT NULL
+    GROUP BY referred_by ORDER BY count(*) DESC, referred_by LIMIT %s
+"""
+
+FARMS_SQL = """
+    SELECT r.referred_by, count(*), count(*) FILTER (WHERE coalesce(l.score, 0) = 0)
+    FROM referrals r LEFT JOIN leaderboard l ON l.id = r.user_id AND l.season = %s
+    WHERE r.referred_at >= %s
+    GROUP BY r.referred_by
+    HAVING count(*) >= %s AND count(*) FILTER (WHERE coalesce(l.score, 0) = 0) >= count(*) * %s
+"""
+
+
+async def seed(users, farms):
+    """A forest where early users refer more (heavy-tailed, a few levels deep), plus farms"""
+    print(f"Seeding {users:,} referred users and {farms} farm(s) of {FARM_SIZE}...")
+    t0 = time.perf_counter()
+    now = time.time()
+    async with bot.db_pool.connection() as conn:
+        await conn.execute("TRUNCATE referrals, leaderboard")
+        await conn.execute("""
+            INSERT INTO referrals (user_id, referred_by, energy_boosts, referred_at)
+            SELECT g, 1 + floor(power(random(), 3) * (g - 1))::bigint, 0, %s - random() * 30 * 86400
+            FROM generate_series(2, %s) g
+        """, (now, users))
+        # Farms: fresh accounts from the last hour, none of which ever syncs
+        await conn.execute("""
+            INSERT INTO referrals (user_id, referred_by, energy_boosts, referred_at)
+            SELECT %s + f * %s + i, %s + f, 0, %s - random() * 3600
+            FROM generate_series(0, %s - 1) f, generate_series(1, %s) i
+        """, (users, FARM_SIZE, 2 * users, now, farms, FARM_SIZE))
+        await conn.execute("""
+            INSERT INTO referrals (user_id, energy_boosts, total_referrals)
+            SELECT referred_by, 0, count(*) FROM referrals GROUP BY referred_by
+            ON CONFLICT (user_id) DO UPDATE SET total_referrals = EXCLUDED.total_referrals
+        """)
+        # Most genuine players sync a score
+        await conn.execute("""
+            INSERT INTO leaderboard (id, name, score, season)
+            SELECT g, 'player' || g, 1 + (random() * 10000)::int, %s
+            FROM generate_series(1, %s) g WHERE random() < 0.7
+        """, (bot.current_season, users))
+        # Lets the recursive query use an index (its best case)
+        await conn.execute("CREATE INDEX IF NOT EXISTS bench_referrals_referred_by_idx ON referrals (referred_by)")
+    async with bot.db_pool.connection() as conn:
+        await conn.set_autocommit(True)
+        await conn.execute("VACUUM ANALYZE referrals")
+        await conn.execute("VACUUM ANALYZE leaderboard")
+    print(f"  done in {time.perf_counter() - t0:.1f}s")
+
+
+async def credit(graph, uid, referrer):
+    now = time.time()
+    assert await bot.credit_referral(uid, referrer, now)
+    await graph.record(uid, referrer, now)
+
+
+async def play(graph, uid):
+    await bot.db_execute("INSERT INTO leaderboard (id, name, score, season) VALUES (%s, %s, 100, %s)",
+                         (uid, f"player{uid}", bot.current_season))
+    graph.mark_active(uid)
+
+
+async def grow(graph, users, below):
+    """Credit referrals through the live path: an idle farm, a busy inviter and a chain"""
+    farm, busy = 3 * users, 3 * users + 1
+    new = iter(range(3 * users + 10, 4 * users))
+    for i in range(graph.farm_min_fresh * 2):
+        await credit(graph, next(new), farm)
+        uid = next(new)
+        await credit(graph, uid, busy)
+        if i % 4 == 0:
+            await play(graph, uid)  # a quarter of them play: not a farm
+    for _ in range(3):
+        uid = next(new)
+        await credit(graph, uid, below)
+        below = uid
+
+
+async def check(graph, roots):
+    ok = True
+    top = [(uid, -count) for count, uid in graph.top]
+    expected = [tuple(row) for row in await bot.db_fetchall(TOP_SQL, (graph.top_size,))]
+    ok &= top == expected
+    print(f"  top inviters match GROUP BY: {top == expected}")
+    for uid in roots:
+        mine = graph.tree(uid)
+        theirs = tuple(await bot.db_fetchone(TREE_SQL, (uid,)))
+        ok &= mine == theirs
+        print(f"  tree of {uid}: {mine[0]:,} players, {mine[1]} deep; matches recursive CTE: {mine == theirs}")
+    now = time.time()
+    farms = sorted(graph.farms(now))
+    expected = sorted(tuple(row) for row in await bot.db_fetchall(FARMS_SQL, (
+        bot.current_season, now - graph.farm_window, graph.farm_min_fresh, graph.farm_idle_ratio)))
+    ok &= farms == expected
+    print(f"  {len(farms)} suspected farm(s) {[uid for uid, _, _ in farms][:8]}; match SQL: {farms == expected}")
+    return ok
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1_000_000)
+    parser.add_argument('--farms', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--no-seed', action='store_true', help="reuse the rows already in the tables")
+    args = parser.parse_args()
+
+    bot.db_pool = bot.create_db_pool()
+    await bot.db_pool.open(wait=True)
+    try:
+        await bot.init_db()
+        if not args.no_seed:
+            await seed(args.users, args.farms)
+
+        # Rows left by grow() on an earlier run
+        await bot.db_execute("DELETE FROM referrals WHERE user_id >= %s", (3 * args.users,))
+        await bot.db_execute("DELETE FROM leaderboard WHERE id >= %s", (3 * args.users,))
+
+        graph = bot.referral_graph
+        print("Bulk load:")
+        t0 = time.perf_counter()
+        await graph.load()
+        print(f"  {len(graph.parent):,} referrals from {len(graph.children):,} referrers "
+              f"in {time.perf_counter() - t0:.2f}s")
+
+        roots = [uid for _, uid in graph.top[:2]] + [args.users // 2]
+        print("Checks:")
+        ok = await check(graph, roots)
+        print("Checks after credits and syncs applied incrementally:")
+        await grow(graph, args.users, roots[-1])
+        ok &= await check(graph, roots)
+
+        print("Top inviters (/inviters):")
+        await timed("cached text", graph.render, args.repeat)
+        await timed("GROUP BY referred_by (naive)", lambda: bot.db_fetchall(TOP_SQL, (graph.top_size,)),
+                    max(3, args.repeat // 10))
+        print("Referral tree of the biggest inviter (/invite):")
+        await timed("in-memory walk", lambda: graph.tree(roots[0]), args.repeat)
+        await timed("recursive CTE (naive)", lambda: bot.db_fetchone(TREE_SQL, (roots[0],)),
+                    max(3, args.repeat // 10))
+        print("Referral tree of an average player:")
+        await timed("in-memory walk", lambda: graph.tree(roots[-1]), args.repeat)
+        await timed("recursive CTE (naive)", lambda: bot.db_fetchone(TREE_SQL, (roots[-1],)), args.repeat)
+        print("Farm detection (/farms):")
+        await timed("recent referrals in memory", graph.farms, args.repeat)
+        await timed("GROUP BY with leaderboard join (naive)", lambda: bot.db_fetchall(FARMS_SQL, (
+            bot.current_season, time.time() - graph.farm_window, graph.farm_min_fresh, graph.farm_idle_ratio)),
+            max(3, args.repeat // 10))
+        print("Credited referral (/start):")
+        next_uid = iter(range(10 * args.users, 11 * args.users))
+        await timed("add to graph", lambda: graph.add(next(next_uid), roots[-1], time.time()), args.repeat)
+    finally:
+        await bot.db_pool.close()
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
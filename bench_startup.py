@@ -0,0 +1,163 @@
+"""Cold start benchmark: time from launching the bot to its first reply.
+
+Launches the bot as a fresh process (bench_load.py's worker mode, against
+the same Bot API stub), POSTs a /start to its webhook port as soon as the
+process exists - retrying until it listens, as Telegram does - and times
+how long the reply takes to reach the stub. Each run is done with the
+schema already up to date and after dropping `schema_version`, which
+makes startup run every migration again like the old unversioned
+init_db(). Also times init_db() itself in-process:
+
+    DATABASE_URL=postgresql://localhost/bert_bench python bench_startup.py --runs 5 --players 100000
+
+--bot-latency and --db-latency add round trips to the Bot API and to every
+SQL statement, closer to a hosted instance than localhost.
+
+WARNING: with --players this replaces every row in `leaderboard`,
+`sync_sessions` and `player_state` - never point it at the production
+database.
+"""
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import statistics
+
+import httpx
+import tornado.web
+import tornado.httpserver
+
+import bench_load
+from bench_load import BotApiStub, DoneReport, STUB_PORT, TOKEN, bot
+from bench_common import timed
+
+WEBHOOK_PORT = 18543
+
+START = {'update_id': 1, 'message': {
+    'message_id': 1, 'date': 0, 'text': '/start',
+    'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+    'chat': {'id': 1_000_001, 'type': 'private', 'first_name': 'P1'},
+    'from': {'id': 1_000_001, 'is_bot': False, 'first_name': 'P1'},
+}}
+
+
+async def seed(players):
+    """Rows for the startup warm-up to load"""
+    print(f"Seeding {players:,} players with recent sessions and game state...")
+    now = time.time()
+    async with bot.db_pool.connection() as conn:
+        await conn.execute("TRUNCATE leaderboard, sync_sessions, player_state")
+        await conn.execute("""
+            INSERT INTO leaderboard (id, name, score, season)
+            SELECT g, 'player' || g, (random() * 100000)::int, %s FROM generate_series(1, %s) g
+        """, (bot.current_season, players))
+        await conn.execute("""
+            INSERT INTO sync_sessions (user_id, score, synced_at)
+            SELECT g, (random() * 100000)::int, %s - random() * 3600 FROM generate_series(1, %s) g
+        """, (now, players))
+        await conn.execute("""
+            INSERT INTO player_state
+            SELECT g, 500, %s - random() * 3600, 1, 0, 1, 1, 0, 0 FROM generate_series(1, %s) g
+        """, (now, players))
+
+
+async def cold_start(args, client):
+    """Seconds from launch to the first reply, and the bot's own startup report"""
+    sent_before = BotApiStub.calls['sendMessage']
+    launched = time.perf_counter()
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, bench_load.__file__, '--serve', str(WEBHOOK_PORT), '--log-level', 'INFO',
+        '--db-latency', str(args.db_latency), stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+    report = []
+
+    async def read_report():
+        async for line in proc.stderr:
+            line = line.decode().rstrip()
+            if '⏱️' in line:
+                report.append(line.split(' - ')[-1])
+            if len(report) == 2:  # first reply and caches warm, in either order
+                return
+
+    reader = asyncio.create_task(read_report())
+    try:
+        while True:
+            try:
+                response = await client.post(f'http://127.0.0.1:{WEBHOOK_PORT}/{TOKEN}', json=START)
+                response.raise_for_status()
+                break
+            except httpx.TransportError:
+                await asyncio.sleep(0.005)
+        while BotApiStub.calls['sendMessage'] == sent_before:
+            await asyncio.sleep(0.001)
+        first_reply = BotApiStub.last_send - launched
+        await asyncio.wait([reader], timeout=args.report_timeout)
+    finally:
+        reader.cancel()
+        proc.terminate()
+        await proc.communicate()
+    return first_reply, report
+
+
+async def drop_schema_version():
+    await bot.db_execute("DROP TABLE IF EXISTS schema_version")
+
+
+async def migrate_again():
+    await drop_schema_version()
+    await bot.init_db()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help="cold starts per mode")
+    parser.add_argument('--players', type=int, default=0, help="seed this many players first")
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--bot-latency', type=float, default=0.0, help="stub Bot API latency in ms")
+    parser.add_argument('--db-latency', type=float, default=0.0, help="extra latency per SQL statement in ms")
+    parser.add_argument('--report-timeout', type=float, default=30.0,
+                        help="seconds to wait for the bot's startup report after the first reply")
+    args = parser.parse_args()
+    logging.getLogger('bot').setLevel(logging.WARNING)
+    logging.getLogger('tornado.access').setLevel(logging.WARNING)
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    BotApiStub.latency = args.bot_latency / 1000
+    stub = tornado.httpserver.HTTPServer(tornado.web.Application([
+        (r"/bench/done", DoneReport),
+        (r"/bot([^/]+)/(\w+)", BotApiStub),
+    ]))
+    stub.listen(STUB_PORT, '127.0.0.1')
+    bench_load.SlowCursor.delay = args.db_latency / 1000
+    bot.db_pool = bot.create_db_pool()
+    bot.db_pool.kwargs['cursor_factory'] = bench_load.SlowCursor
+    await bot.db_pool.open(wait=True)
+    try:
+        await bot.init_db()
+        if args.players:
+            await seed(args.players)
+
+        print("init_db():")
+        await timed("schema up to date (one SELECT)", bot.init_db, args.repeat)
+        await timed("every migration (unversioned DDL)", migrate_again, max(5, args.repeat // 5))
+
+        async with httpx.AsyncClient() as client:
+            for label, prepare in (("schema up to date", None), ("migrating", drop_schema_version)):
+                print(f"Cold start, {label}:")
+                samples = []
+                for _ in range(args.runs):
+                    if prepare:
+                        await prepare()
+                    first_reply, report = await cold_start(args, client)
+                    samples.append(first_reply)
+                print(f"  first reply after launch: median {statistics.median(samples):.2f}s  "
+                      f"min {min(samples):.2f}s  max {max(samples):.2f}s")
+                for line in report:
+                    print(f"  last run: {line}")
+    finally:
+        stub.stop()
+        await bot.db_pool.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,122 @@
+"""Check and benchmark for the server-side tap batch anti-cheat.
+
+Builds tap batches for human and bot tapping profiles, checks that the
+vectorised analysis in bot.py agrees with a per-tap Python loop and flags
+only the bots, then times decoding plus analysis of one sync's batch at
+several sizes against the loop:
+
+    python bench_taps.py --sizes 100,700,2000,5000,10000
+
+No database is needed. Exits non-zero if a check fails.
+"""
+import os
+import sys
+import base64
+import logging
+import argparse
+
+import numpy as np
+
+os.environ.setdefault('BOT_TOKEN', 'bench')
+os.environ.setdefault('DATABASE_URL', 'postgresql://localhost/unused')
+
+import bot
+from bench_common import timed_sync
+
+logging.getLogger('bot').setLevel(logging.WARNING)
+
+
+def encode_taps(gaps, xs, ys):
+    """The wire format index.html sends: uint16 gaps, then x, then y, base64"""
+    raw = (np.asarray(gaps, dtype='<u2').tobytes() + np.asarray(xs, dtype=np.uint8).tobytes()
+           + np.asarray(ys, dtype=np.uint8).tobytes())
+    return base64.b64encode(raw).decode('ascii')
+
+
+def positions(rng, n, spread=30):
+    return np.clip(np.rint(rng.normal(128, spread, (2, n))), 0, 255)
+
+
+def human_taps(rng, n, mean_gap=120):
+    """Irregular gaps around `mean_gap` ms, scattered around the middle of the face"""
+    gaps = np.clip(np.rint(rng.gamma(6, mean_gap / 6, n)), 0, 65535)
+    return (gaps, *positions(rng, n))
+
+
+PROFILES = {
+    # name: (batch builder, expected to be flagged)
+    'human': (human_taps, False),
+    'fast human (14/s)': (lambda rng, n: human_taps(rng, n, mean_gap=70), False),
+    'auto-tapper (50/s)': (lambda rng, n: (np.full(n, 20), np.full(n, 128), np.full(n, 128)), True),
+    'steady bot (15/s, moving)': (lambda rng, n: (rng.integers(65, 68, n), *positions(rng, n)), True),
+    'same-spot clicker': (lambda rng, n: (human_taps(rng, n)[0], np.full(n, 90), np.full(n, 140)), True),
+}
+
+
+def analyze_taps_loop(gaps, xs, ys):
+    """The same counts as bot.analyze_taps, one tap at a time"""
+    gaps, xs, ys = gaps.tolist(), xs.tolist(), ys.tolist()
+    k, m = bot.PATTERN_CHECK_SIZE - 1, bot.MAX_SAME_POSITION_TAPS
+    rate = interval = variance = position = 0
+    times, now, start = [], 0, 0
+    for i, gap in enumerate(gaps):
+        now += gap
+        times.append(now)
+        while now - times[start] >= 1000:
+            start += 1
+        if i - start + 1 > bot.MAX_TAPS_PER_SECOND:
+            rate += 1
+        if gap < bot.MIN_TAP_INTERVAL:
+            interval += 1
+        if i >= k - 1:
+            window = gaps[i - k + 1:i + 1]
+            total = sum(window)
+            # variance < threshold, kept in integers like the vectorised version
+            if (k * sum(g * g for g in window) - total * total < bot.VARIANCE_THRESHOLD * k * k
+                    and total < bot.VARIANCE_MAX_INTERVAL * k):
+                variance += 1
+        if i >= m and all(xs[j] == xs[i] and ys[j] == ys[i] for j in range(i - m, i)):
+            position += 1
+    return bot.TapReport(len(gaps), rate, interval, variance, position)
+
+
+def check(rng, size):
+    ok = True
+    print(f"Verdicts ({size} taps per batch):")
+    for name, (build, cheat) in PROFILES.items():
+        gaps, xs, ys = bot.decode_taps(encode_taps(*build(rng, size)))
+        report = bot.analyze_taps(gaps, xs, ys)
+        failed = bot.tap_violations(report)
+        agrees = report == analyze_taps_loop(gaps, xs, ys)
+        correct = bool(failed) == cheat and agrees
+        ok &= correct
+        print(f"  {name:<28} {', '.join(failed) or 'clean':<34} "
+              f"{'ok' if correct else 'WRONG' if agrees else 'LOOP MISMATCH'}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='100,700,2000,5000,10000',
+                        help="comma-separated taps per batch")
+    parser.add_argument('--repeat', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+    rng = np.random.default_rng(args.seed)
+
+    ok = check(rng, 700)
+
+    for size in sizes:
+        blob = encode_taps(*human_taps(rng, size))
+        print(f"{size:,} taps ({len(blob):,} bytes of base64):")
+        timed_sync("decode + vectorised checks", lambda: bot.tap_violations(bot.analyze_taps(*bot.decode_taps(blob))),
+                   args.repeat)
+        timed_sync("decode + per-tap loop (naive)", lambda: analyze_taps_loop(*bot.decode_taps(blob)),
+                   max(5, args.repeat // 50))
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
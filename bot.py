@@ -1,17 +1,162 @@
+import io
 import os
-import psycopg
+import re
+import csv
+import gzip
 import json
+import base64
+import asyncio
+import tempfile
+import socket
+import atexit
 import logging
 import time
-from collections import defaultdict
-from telegram import Update, KeyboardButton, ReplyKeyboardMarkup, WebAppInfo
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+import heapq
+import itertools
+import weakref
+import functools
+from bisect import bisect_left, insort
+from collections import defaultdict, deque, namedtuple, OrderedDict
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue, Full as QueueFull
+import numpy as np
+from telegram import Update, InputFile, KeyboardButton, ReplyKeyboardMarkup, WebAppInfo, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import (Application, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler,
+                          MessageHandler, filters, ContextTypes)
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.request import HTTPXRequest
+from psycopg import AsyncConnection, AsyncCursor
+from psycopg.errors import UndefinedTable
+from psycopg_pool import AsyncConnectionPool
+from prometheus_client import Gauge, Histogram, start_http_server
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily, REGISTRY
 
 # Environment variables
 TOKEN = os.getenv('BOT_TOKEN')
 DATABASE_URL = os.getenv('DATABASE_URL')
 WEBHOOK_URL = os.getenv('WEBHOOK_URL', 'https://bert-tap-attack-s9db.onrender.com')
 PORT = int(os.getenv('PORT', '10000'))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))  # parallel deliveries from Telegram
+
+# Multi-worker mode: the number of processes/instances serving the webhook.
+# Above 1, per-user rate state lives in Postgres and caches follow each
+# other through LISTEN/NOTIFY (see WorkerSync)
+WORKERS = int(os.getenv('WORKERS', '1'))
+MULTI_WORKER = WORKERS > 1
+
+# Prometheus metrics server (separate from the webhook port; 0 disables it)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9090'))
+
+# Updates handled at once (updates from one user always run one after another)
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '32'))
+
+# Connection pool sizing (shared by every handler)
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '2'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+DB_POOL_MAX_IDLE = float(os.getenv('DB_POOL_MAX_IDLE', '300'))
+DB_POOL_CHECK_IDLE = float(os.getenv('DB_POOL_CHECK_IDLE', '30'))  # ping connections idle this long
+
+# Write-behind score buffer: flush every N seconds or once this many users are pending
+SCORE_FLUSH_INTERVAL = float(os.getenv('SCORE_FLUSH_INTERVAL', '1.0'))
+SCORE_FLUSH_MAX = int(os.getenv('SCORE_FLUSH_MAX', '500'))
+
+# Process-local top-K cache; only the first LEADERBOARD_SIZE entries are shown
+LEADERBOARD_CACHE_SIZE = int(os.getenv('LEADERBOARD_CACHE_SIZE', '100'))
+LEADERBOARD_SIZE = 10
+
+# Anti-cheat Check 5: score gained per second may not exceed tap rate x tap power
+MAX_SCORE = 10000000
+MAX_TAPS_PER_SECOND = int(os.getenv('MAX_TAPS_PER_SECOND', '20'))  # same as index.html
+MAX_TAP_POWER = int(os.getenv('MAX_TAP_POWER', '30'))
+SCORE_RATE_GRACE = float(os.getenv('SCORE_RATE_GRACE', '5'))  # seconds of slack per sync
+SESSION_MAX_USERS = int(os.getenv('SESSION_MAX_USERS', '100000'))
+SESSION_FLUSH_INTERVAL = float(os.getenv('SESSION_FLUSH_INTERVAL', '30'))
+
+# Game economy as in index.html. Energy refills and boosts decay as a function
+# of elapsed time, worked out whenever a player's state is read (see PlayerState)
+BASE_ENERGY = 1000
+ENERGY_PER_LEVEL = 500
+REGEN_PER_LEVEL = 0.2  # energy per second on top of 1
+BOOST_COSTS = {'tap': 100, 'energy': 500, 'regen': 300}  # doubling with every level
+CARD_COSTS = {1: 1000000}
+CARD_MASK = sum(1 << (card - 1) for card in CARD_COSTS)
+CARD_ITEMS = {f"card:{card}": card for card in CARD_COSTS}  # purchase name -> card id
+BOOST_LEVEL_CAP_WITHOUT_CARD = 5
+BOOST_DECAY_SECONDS = 4 * 3600
+MAX_BUYS_PER_SYNC = 100
+PLAYER_STATE_MAX_USERS = int(os.getenv('PLAYER_STATE_MAX_USERS', '100000'))
+PLAYER_STATE_FLUSH_INTERVAL = float(os.getenv('PLAYER_STATE_FLUSH_INTERVAL', '5'))
+
+# Tap batches sent with a sync are rechecked with the thresholds index.html uses.
+# A layer flags the player once it fails on TAP_FLAG_RATIO of the batch (and at least TAP_FLAG_MIN_HITS times)
+MIN_TAP_INTERVAL = 25  # ms
+VARIANCE_THRESHOLD = 5  # ms², over PATTERN_CHECK_SIZE taps averaging under VARIANCE_MAX_INTERVAL ms apart
+VARIANCE_MAX_INTERVAL = 80
+PATTERN_CHECK_SIZE = 20
+MAX_SAME_POSITION_TAPS = 5
+TAP_BATCH_MAX = int(os.getenv('TAP_BATCH_MAX', '10000'))
+TAP_FLAG_RATIO = float(os.getenv('TAP_FLAG_RATIO', '0.1'))
+TAP_FLAG_MIN_HITS = int(os.getenv('TAP_FLAG_MIN_HITS', '8'))
+
+# Referral graph: entries on /inviters, and what counts as a referral farm - a referrer
+# with at least REFERRAL_FARM_MIN_FRESH referrals in the last REFERRAL_FARM_WINDOW
+# seconds, REFERRAL_FARM_IDLE_RATIO of them without a score yet
+TOP_INVITERS_SIZE = 10
+REFERRAL_FARM_WINDOW = float(os.getenv('REFERRAL_FARM_WINDOW', str(24 * 3600)))
+REFERRAL_FARM_MIN_FRESH = int(os.getenv('REFERRAL_FARM_MIN_FRESH', '20'))
+REFERRAL_FARM_IDLE_RATIO = float(os.getenv('REFERRAL_FARM_IDLE_RATIO', '0.8'))
+REFERRAL_REFRESH_INTERVAL = float(os.getenv('REFERRAL_REFRESH_INTERVAL', '60'))  # multi-worker activity refresh
+
+# web_app_data throttling: (tokens per second, burst) per action
+THROTTLE_LIMITS = {
+    'sync': (float(os.getenv('THROTTLE_SYNC_RATE', '0.5')), float(os.getenv('THROTTLE_SYNC_BURST', '3'))),
+    'get_boosts': (float(os.getenv('THROTTLE_GET_BOOSTS_RATE', '0.2')), float(os.getenv('THROTTLE_GET_BOOSTS_BURST', '2'))),
+    'use_boost': (float(os.getenv('THROTTLE_USE_BOOST_RATE', '0.2')), float(os.getenv('THROTTLE_USE_BOOST_BURST', '2'))),
+}
+THROTTLE_MAX_USERS = int(os.getenv('THROTTLE_MAX_USERS', '100000'))
+
+# Redelivered webhook updates: update_ids are remembered for UPDATE_DEDUP_TTL seconds
+# (at most UPDATE_DEDUP_MAX per worker). UPDATE_DEDUP_DB also claims them in Postgres,
+# shared by every worker and kept across restarts (on by default with several workers)
+UPDATE_DEDUP_TTL = float(os.getenv('UPDATE_DEDUP_TTL', '3600'))
+UPDATE_DEDUP_MAX = int(os.getenv('UPDATE_DEDUP_MAX', '100000'))
+UPDATE_DEDUP_DB = os.getenv('UPDATE_DEDUP_DB', '1' if MULTI_WORKER else '0') != '0'
+BOOST_KEY_TTL = 24 * 3600  # how long a use_boost idempotency key is remembered
+BOOST_KEY_MAX_LENGTH = 64
+
+# Past seasons are copied to leaderboard_archive in chunks of this many rows
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', '5000'))
+
+# Cheater log queue: flush interval and max distinct users held between flushes
+CHEATER_FLUSH_INTERVAL = float(os.getenv('CHEATER_FLUSH_INTERVAL', '5'))
+CHEATER_QUEUE_MAX = int(os.getenv('CHEATER_QUEUE_MAX', '10000'))
+
+# /debug: rows shown inline, and rows fetched per round trip when exporting
+DEBUG_TEXT_ROWS = int(os.getenv('DEBUG_TEXT_ROWS', '50'))
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', '2000'))
+# Bots may upload 50 MB per file: larger exports are sent in parts of this size
+EXPORT_PART_SIZE = int(os.getenv('EXPORT_PART_SIZE', str(48 * 1024 * 1024)))
+EXPORT_WRITE_TIMEOUT = float(os.getenv('EXPORT_WRITE_TIMEOUT', '300'))  # seconds per upload
+
+# Outbound messages: Telegram allows about 30/s overall and 1/s per chat (short bursts are fine)
+SEND_RATE = float(os.getenv('SEND_RATE', str(25 / WORKERS)))  # per worker
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', '1'))
+SEND_CHAT_BURST = int(os.getenv('SEND_CHAT_BURST', '3'))
+SEND_CONCURRENCY = int(os.getenv('SEND_CONCURRENCY', '8'))
+SEND_MAX_ATTEMPTS = 3
+SEND_CHAT_QUEUE = int(os.getenv('SEND_CHAT_QUEUE', '20'))  # messages waiting per chat, oldest dropped beyond
+SEND_DRAIN_TIMEOUT = float(os.getenv('SEND_DRAIN_TIMEOUT', '10'))  # at shutdown
+BROADCAST_BUFFER = 1000
+BROADCAST_BATCH_SIZE = 1000
+
+# Logging: LOG_FORMAT=json writes one JSON object per line; with LOG_ASYNC records are
+# formatted and written by a background thread. High-volume success events are
+# sampled per message at LOG_SAMPLE_RATE (warnings, errors and cheat flags never are)
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_ASYNC = os.getenv('LOG_ASYNC', '1') != '0'
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '0.01'))
+LOG_QUEUE_MAX = int(os.getenv('LOG_QUEUE_MAX', '10000'))  # records waiting for the writer thread
 
 if not TOKEN:
     raise ValueError("BOT_TOKEN environment variable not set!")
@@ -20,113 +165,2264 @@ if not DATABASE_URL:
 
 GITHUB_URL = "https://thelegacyofbertfoundation-spec.github.io/Bert-Tap-Attack/"
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# SECURITY: Add your Telegram user ID here
+ADMIN_USER_IDS = [7137489161]  # Replace with your actual user ID
+
+# === LOGGING ===
+# High-volume success events go through log_sampled(), which writes them at
+# LOG_SAMPLE_RATE and decides before a record is even built; so are the
+# per-request lines of the HTTP client. Everything else is always written.
+
+class LogSampler(logging.Filter):
+    """Keeps one in every 1/`rate` records of each event.
+
+    An event is an unformatted message, so each is sampled on its own, and a
+    record that is kept carries the number of records it stands for as
+    `sample_weight`. As a filter it samples the INFO records of `loggers`.
+    """
+
+    def __init__(self, rate, loggers=()):
+        super().__init__()
+        self.every = max(1, round(1 / rate)) if rate > 0 else 0
+        self.loggers = frozenset(loggers)
+        self.seen = defaultdict(int)
+        self.skipped = 0
+
+    def take(self, event):
+        """The weight to log this occurrence of `event` with, or 0 to skip it"""
+        if self.every == 1:
+            return 1
+        seen = self.seen[event]
+        self.seen[event] = seen + 1
+        if not self.every or seen % self.every:
+            self.skipped += 1
+            return 0
+        return self.every
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or record.name not in self.loggers:
+            return True
+        record.sample_weight = self.take(record.msg)
+        return record.sample_weight > 0
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record; `event` is the unformatted message, for grouping"""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'event': str(record.msg),
+            'msg': record.getMessage(),
+        }
+        weight = getattr(record, 'sample_weight', 1)
+        if weight != 1:
+            entry['sampled'] = weight
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class BackgroundLogHandler(QueueHandler):
+    """Hands records to a QueueListener thread, which formats and writes them.
+
+    Unlike the stock QueueHandler the record is not formatted in the calling
+    thread, so logging costs the event loop little more than a queue put
+    (arguments are formatted later and must not be mutated after the call).
+    Records arriving while `maxsize` are waiting are dropped and counted.
+    """
+
+    def __init__(self, maxsize):
+        super().__init__(Queue(maxsize))
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except QueueFull:
+            self.dropped += 1
+
+log_sampler = LogSampler(LOG_SAMPLE_RATE, loggers=('httpx',))
+log_output = logging.StreamHandler()
+log_output.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else
+                        logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+if LOG_ASYNC:
+    log_handler = BackgroundLogHandler(LOG_QUEUE_MAX)
+    log_listener = QueueListener(log_handler.queue, log_output)
+    log_listener.start()
+    atexit.register(log_listener.stop)  # writes whatever is still queued
+else:
+    log_handler = log_output
+log_handler.addFilter(log_sampler)
+
+logging.basicConfig(level=logging.INFO, handlers=[log_handler])
 logger = logging.getLogger(__name__)
 
-last_sync = defaultdict(float)
+def log_sampled(msg, *args):
+    """logger.info() for a high-volume success event, written at LOG_SAMPLE_RATE"""
+    if logger.isEnabledFor(logging.INFO):
+        weight = log_sampler.take(msg)
+        if weight:
+            logger.info(msg, *args, extra={'sample_weight': weight}, stacklevel=2)
 
-def init_db():
-    try:
-        conn = psycopg.connect(DATABASE_URL)
-        c = conn.cursor()
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS leaderboard (
-                id BIGINT PRIMARY KEY, 
-                name TEXT, 
-                score INTEGER
-            )
-        """)
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS referrals (
-                user_id BIGINT PRIMARY KEY,
-                referred_by BIGINT,
-                energy_boosts INTEGER DEFAULT 0,
-                total_referrals INTEGER DEFAULT 0
-            )
-        """)
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS cheaters (
-                user_id BIGINT PRIMARY KEY,
-                username TEXT,
-                first_flagged TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                flag_count INTEGER DEFAULT 1,
-                last_flag_reason TEXT,
-                suspicious_count INTEGER DEFAULT 0
-            )
-        """)
-        conn.commit()
-        c.close()
-        conn.close()
-        logger.info("✅ Database initialized")
-    except Exception as e:
-        logger.error("❌ Database error: %s", e)
+class Throttle:
+    """Per-user token buckets for web_app_data, checked before any parsing or DB work.
+
+    Each action refills at `rate` tokens per second up to `burst`. The first
+    request over the limit gets a "slow down" reply, later ones are dropped
+    silently until a token is available again. Buckets that would be full
+    anyway are forgotten, and at most `max_users` are kept per action.
+    """
+
+    ALLOW, WARN, DROP = "allow", "warn", "drop"
+
+    # Cluster-wide bucket for multi-worker mode, timed by the database clock
+    SHARED_TAKE = """
+        INSERT INTO throttle_buckets AS b (user_id, action, tokens, updated_at)
+        VALUES (%(uid)s, %(action)s, %(burst)s - 1, extract(epoch FROM clock_timestamp()))
+        ON CONFLICT (user_id, action) DO UPDATE
+        SET tokens = least(%(burst)s, b.tokens + (EXCLUDED.updated_at - b.updated_at) * %(rate)s) - 1,
+            updated_at = EXCLUDED.updated_at
+        WHERE least(%(burst)s, b.tokens + (EXCLUDED.updated_at - b.updated_at) * %(rate)s) >= 1
+        RETURNING tokens
+    """
+
+    def __init__(self, limits, max_users):
+        self.limits = limits
+        self.max_users = max_users
+        self.buckets = {action: OrderedDict() for action in limits}  # uid -> [tokens, last, warned]
+        self.shed = defaultdict(int)
+        self.warned = defaultdict(int)
+
+    def allow(self, uid, action, now=None):
+        now = time.monotonic() if now is None else now
+        rate, burst = self.limits[action]
+        buckets = self.buckets[action]
+        bucket = buckets.pop(uid, None)
+        if bucket is None:
+            bucket = [burst, now, False]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        buckets[uid] = bucket
+        self._evict(buckets, now, burst / rate)
+        
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            bucket[2] = False
+            return self.ALLOW
+        self.shed[action] += 1
+        if bucket[2]:
+            return self.DROP
+        bucket[2] = True
+        self.warned[action] += 1
+        return self.WARN
+
+    async def allow_shared(self, uid, action):
+        """allow() across every worker: the local bucket first, then the one in Postgres.
+
+        The local check still sheds floods aimed at this worker without a
+        round trip; a request it lets through is charged to the shared bucket.
+        """
+        previous = self.buckets[action].get(uid)
+        was_warned = previous[2] if previous else False
+        verdict = self.allow(uid, action)
+        if verdict != self.ALLOW:
+            return verdict
+        rate, burst = self.limits[action]
+        row = await db_fetchone_atomic(self.SHARED_TAKE, {
+            'uid': uid, 'action': action, 'rate': rate, 'burst': burst})
+        if row is not None:
+            return self.ALLOW
+        self.shed[action] += 1
+        bucket = self.buckets[action].get(uid)
+        if bucket is not None:
+            bucket[2] = True
+        if was_warned:
+            return self.DROP
+        self.warned[action] += 1
+        return self.WARN
+
+    def _evict(self, buckets, now, refill_time):
+        while buckets:
+            uid, (_, last, _) = next(iter(buckets.items()))
+            if len(buckets) <= self.max_users and now - last <= refill_time:
+                break
+            del buckets[uid]
+
+throttle = Throttle(THROTTLE_LIMITS, THROTTLE_MAX_USERS)
+
+def webapp_action(raw):
+    """Cheap action lookup on the raw payload so throttling can run before json.loads"""
+    for action in ('use_boost', 'get_boosts'):
+        if f'"{action}"' in raw:
+            return action
+    return 'sync'
+
+# === METRICS ===
+# Prometheus text format on METRICS_PORT (/metrics). Handlers are timed with
+# @instrumented, every SQL statement through TimedCursor, and every Bot API
+# call through TimedRequest; pool and buffer stats are read at scrape time.
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+HANDLER_SECONDS = Histogram(
+    'bert_handler_seconds', 'Update handler latency', ['handler'], buckets=LATENCY_BUCKETS)
+DB_QUERY_SECONDS = Histogram(
+    'bert_db_query_seconds', 'SQL statement latency', ['statement'], buckets=LATENCY_BUCKETS)
+TELEGRAM_SEND_SECONDS = Histogram(
+    'bert_telegram_request_seconds', 'Bot API request latency', ['method'], buckets=LATENCY_BUCKETS)
+UPDATES_IN_FLIGHT = Gauge('bert_updates_in_flight', 'Updates currently being handled')
+
+def instrumented(name):
+    """Decorator timing a handler and tracking updates in flight"""
+    def decorate(handler):
+        observe = HANDLER_SECONDS.labels(name).observe
+        
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            UPDATES_IN_FLIGHT.inc()
+            start = time.perf_counter()
+            try:
+                return await handler(update, context)
+            finally:
+                observe(time.perf_counter() - start)
+                UPDATES_IN_FLIGHT.dec()
+        return wrapper
+    return decorate
+
+_TABLE_RE = re.compile(
+    r"\b(FROM|INTO|UPDATE|TABLE|INDEX)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?([a-z_]+)(\s*\()?", re.I)
+
+@functools.lru_cache(maxsize=512)
+def statement_label(query):
+    """Low-cardinality label for a statement, e.g. 'SELECT leaderboard'"""
+    if not query.strip():
+        return "PING"  # pool health check
+    verb = query.lstrip(" \n(").split(None, 1)[0].upper()
+    for keyword, name, call in _TABLE_RE.findall(query):
+        if not (call and keyword.upper() == "FROM"):  # skip FROM unnest(...)
+            return f"{verb} {name}"
+    return verb
+
+class TimedCursor(AsyncCursor):
+    """Cursor that records every execute() in bert_db_query_seconds"""
+
+    async def execute(self, query, params=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            label = statement_label(query if isinstance(query, str) else str(query))
+            DB_QUERY_SECONDS.labels(label).observe(time.perf_counter() - start)
+
+class TimedRequest(HTTPXRequest):
+    """Bot API transport that records request latency per method"""
 
-def update_db(uid, name, score):
+    async def do_request(self, url, method, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = await super().do_request(url, method, *args, **kwargs)
+            if result[0] == 200:
+                startup.observe(url.rsplit("/", 1)[-1])
+            return result
+        finally:
+            TELEGRAM_SEND_SECONDS.labels(url.rsplit("/", 1)[-1]).observe(time.perf_counter() - start)
+
+class RuntimeCollector:
+    """Reads pool, buffer and throttle stats when Prometheus scrapes"""
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        if db_pool is not None:
+            stats = db_pool.get_stats()
+            for key in ("pool_min", "pool_max", "pool_size", "pool_available", "requests_waiting"):
+                g = GaugeMetricFamily(f"bert_db_{key}", f"psycopg pool {key}")
+                g.add_metric([], stats.get(key, 0))
+                yield g
+            for key in ("requests_num", "requests_queued", "requests_errors", "connections_num", "connections_errors"):
+                c = CounterMetricFamily(f"bert_db_{key}", f"psycopg pool {key}")
+                c.add_metric([], stats.get(key, 0))
+                yield c
+        pending = GaugeMetricFamily("bert_pending_writes", "Rows waiting in write-behind buffers", labels=["buffer"])
+        pending.add_metric(["scores"], len(score_buffer.pending))
+        pending.add_metric(["cheaters"], len(cheater_queue.pending))
+        pending.add_metric(["sessions"], len(session_tracker.dirty))
+        pending.add_metric(["player_state"], len(player_states.pending))
+        yield pending
+        outbound = GaugeMetricFamily("bert_send_queue", "Outbound messages waiting", labels=["queue"])
+        outbound.add_metric(["replies"], send_queue.pending())
+        outbound.add_metric(["broadcast"], send_queue.bulk.qsize())
+        yield outbound
+        sent = CounterMetricFamily("bert_messages", "Outbound messages by outcome", labels=["outcome"])
+        for outcome in ("sent", "blocked", "failed", "dropped"):
+            sent.add_metric([outcome], send_queue.outcomes[outcome])
+        yield sent
+        shed = CounterMetricFamily("bert_throttled", "web_app_data requests shed by throttling", labels=["action"])
+        for action in THROTTLE_LIMITS:
+            shed.add_metric([action], throttle.shed[action])
+        yield shed
+        repeated = CounterMetricFamily("bert_repeated_requests", "Redelivered updates and repeated use_boost keys dropped",
+                                       labels=["kind"])
+        repeated.add_metric(["update"], update_dedup.duplicates)
+        repeated.add_metric(["use_boost"], update_dedup.repeated_boosts)
+        yield repeated
+        started = GaugeMetricFamily("bert_startup_seconds", "Seconds from process launch to each startup phase",
+                                    labels=["phase"])
+        for phase, seconds in startup.at.items():
+            started.add_metric([phase], seconds)
+        yield started
+        referrals = GaugeMetricFamily("bert_referrals", "Referral edges in the in-memory graph")
+        referrals.add_metric([], len(referral_graph.parent))
+        yield referrals
+        rejected = CounterMetricFamily("bert_score_rate_rejections", "Syncs rejected by the score-rate check")
+        rejected.add_metric([], session_tracker.rejected)
+        yield rejected
+        flagged = CounterMetricFamily("bert_tap_flags", "Syncs rejected by the tap batch checks", labels=["layer"])
+        for layer in TapReport._fields[1:]:
+            flagged.add_metric([layer], tap_flags[layer])
+        yield flagged
+        unlogged = CounterMetricFamily("bert_log_records_skipped", "Log records not written", labels=["reason"])
+        unlogged.add_metric(["sampled"], log_sampler.skipped)
+        unlogged.add_metric(["queue_full"], getattr(log_handler, 'dropped', 0))
+        yield unlogged
+
+REGISTRY.register(RuntimeCollector())
+
+# Shared async connection pool - created in main(), opened in post_init()
+db_pool = None
+
+background_tasks = set()
+
+def spawn(coro):
+    """Run a coroutine in the background, keeping a reference until it finishes"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def db_execute(query, params=None):
+    """Run a statement on a pooled connection and commit"""
+    async with db_pool.connection() as conn:
+        await conn.execute(query, params)
+
+async def db_fetchone(query, params=None):
+    """Run a query on a pooled connection and return the first row"""
+    async with db_pool.connection() as conn:
+        cur = await conn.execute(query, params)
+        return await cur.fetchone()
+
+async def db_fetchall(query, params=None):
+    """Run a query on a pooled connection and return all rows"""
+    async with db_pool.connection() as conn:
+        cur = await conn.execute(query, params)
+        return await cur.fetchall()
+
+async def db_fetchone_atomic(query, params=None):
+    """Run one self-contained statement in a single round trip and return the first row.
+
+    The statement runs in autocommit (no BEGIN/COMMIT round trips) and is
+    prepared on first use on each pooled connection.
+    """
+    async with db_pool.connection() as conn:
+        await conn.set_autocommit(True)
+        try:
+            cur = await conn.execute(query, params, prepare=True)
+            return await cur.fetchone()
+        finally:
+            if not conn.broken:
+                await conn.set_autocommit(False)
+
+_conn_last_used = weakref.WeakKeyDictionary()
+
+async def check_connection(conn):
+    """Health-check a connection on checkout, unless it was used moments ago"""
+    if time.monotonic() - _conn_last_used.get(conn, 0) > DB_POOL_CHECK_IDLE:
+        await AsyncConnectionPool.check_connection(conn)
+
+async def mark_connection_used(conn):
+    _conn_last_used[conn] = time.monotonic()
+
+def create_db_pool():
+    """Build the connection pool (opened later, inside the bot's event loop)"""
+    return AsyncConnectionPool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        timeout=DB_POOL_TIMEOUT,
+        max_idle=DB_POOL_MAX_IDLE,
+        check=check_connection,
+        reset=mark_connection_used,
+        kwargs={"cursor_factory": TimedCursor},
+        name="bert-db",
+        open=False,
+    )
+
+# === SCHEMA ===
+# Migrations run once per database, in order; `schema_version` holds the
+# number applied so far, so a database that is up to date costs one SELECT
+# at startup instead of every CREATE ... IF NOT EXISTS. To change the
+# schema, append a step - never edit one that has already run somewhere.
+
+SCHEMA_LOCK = 0x62657275  # advisory lock key: one worker migrates at a time
+
+async def migrate_base(conn):
+    """1: everything init_db() used to create on every boot.
+
+    It is idempotent, so databases created before versioning adopt it.
+    """
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS leaderboard (
+            id BIGINT PRIMARY KEY, 
+            name TEXT, 
+            score INTEGER
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS referrals (
+            user_id BIGINT PRIMARY KEY,
+            referred_by BIGINT,
+            energy_boosts INTEGER DEFAULT 0,
+            total_referrals INTEGER DEFAULT 0
+        )
+    """)
+    await conn.execute("ALTER TABLE referrals ADD COLUMN IF NOT EXISTS referred_at DOUBLE PRECISION")
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS cheaters (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            first_flagged TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            flag_count INTEGER DEFAULT 1,
+            last_flag_reason TEXT,
+            suspicious_count INTEGER DEFAULT 0
+        )
+    """)
+    await conn.execute("""
+        CREATE INDEX IF NOT EXISTS cheaters_first_flagged_idx ON cheaters (first_flagged DESC)
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS sync_sessions (
+            user_id BIGINT PRIMARY KEY,
+            score BIGINT NOT NULL,
+            synced_at DOUBLE PRECISION NOT NULL
+        )
+    """)
+    await conn.execute("""
+        CREATE UNLOGGED TABLE IF NOT EXISTS processed_updates (
+            update_id BIGINT PRIMARY KEY,
+            seen_at DOUBLE PRECISION NOT NULL
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS boost_spends (
+            user_id BIGINT NOT NULL,
+            key TEXT NOT NULL,
+            spent_at DOUBLE PRECISION NOT NULL,
+            PRIMARY KEY (user_id, key)
+        )
+    """)
+    await conn.execute("""
+        CREATE UNLOGGED TABLE IF NOT EXISTS throttle_buckets (
+            user_id BIGINT NOT NULL,
+            action TEXT NOT NULL,
+            tokens DOUBLE PRECISION NOT NULL,
+            updated_at DOUBLE PRECISION NOT NULL,
+            PRIMARY KEY (user_id, action)
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS player_state (
+            user_id BIGINT PRIMARY KEY,
+            energy REAL NOT NULL,
+            updated_at DOUBLE PRECISION NOT NULL,
+            tap_level INTEGER NOT NULL,
+            tap_at DOUBLE PRECISION NOT NULL,
+            energy_level INTEGER NOT NULL,
+            regen_level INTEGER NOT NULL,
+            regen_at DOUBLE PRECISION NOT NULL,
+            cards INTEGER NOT NULL
+        )
+    """)
+    await init_seasons(conn)
+    await init_rank_index(conn)
+
+MIGRATIONS = [migrate_base]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+async def migrate(conn):
+    """Apply the migrations this database lacks, in the caller's transaction"""
+    await conn.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK,))
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            one BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (one),
+            version INTEGER NOT NULL
+        )
+    """)
+    await conn.execute("INSERT INTO schema_version (version) VALUES (0) ON CONFLICT DO NOTHING")
+    # Another worker may have migrated while we waited for the lock
+    cur = await conn.execute("SELECT version FROM schema_version")
+    found = (await cur.fetchone())[0]
+    for version in range(found + 1, SCHEMA_VERSION + 1):
+        await MIGRATIONS[version - 1](conn)
+        logger.info("✅ Schema migration %s (%s) applied", version, MIGRATIONS[version - 1].__name__)
+    if found < SCHEMA_VERSION:
+        await conn.execute("UPDATE schema_version SET version = %s", (SCHEMA_VERSION,))
+
+async def init_db():
+    """Bring the schema up to date and read the current season.
+
+    Errors are logged and re-raised: started without knowing the season,
+    the bot would serve and overwrite season 1 as if it were current.
+    """
+    global current_season
     try:
-        conn = psycopg.connect(DATABASE_URL)
-        c = conn.cursor()
-        c.execute("""
-            INSERT INTO leaderboard (id, name, score) 
-            VALUES (%s, %s, %s)
-            ON CONFLICT (id) DO UPDATE SET name = %s, score = %s
-        """, (uid, str(name), int(score), str(name), int(score)))
-        conn.commit()
-        c.close()
-        conn.close()
-        logger.info("✅ Score updated: User %s = %s", uid, score)
+        async with db_pool.connection() as conn:
+            try:
+                cur = await conn.execute("""
+                    SELECT version, (SELECT max(season) FROM seasons) FROM schema_version
+                """)
+                version, season = await cur.fetchone()
+            except UndefinedTable:
+                await conn.rollback()
+                version = season = None
+            if version is None or version < SCHEMA_VERSION:
+                await migrate(conn)
+                cur = await conn.execute("SELECT max(season) FROM seasons")
+                season = (await cur.fetchone())[0]
+            elif version > SCHEMA_VERSION:
+                logger.warning("⚠️ Database schema %s is newer than this code's (%s)", version, SCHEMA_VERSION)
+            else:
+                logger.info("✅ Database schema up to date (%s)", version)
+            current_season = season
     except Exception as e:
-        logger.error("❌ DB update error: %s", e)
+        logger.error("❌ Database error: %s", e)
         raise
 
-def get_rank():
-    try:
-        conn = psycopg.connect(DATABASE_URL)
-        c = conn.cursor()
-        c.execute("SELECT name, score FROM leaderboard ORDER BY score DESC LIMIT 10")
-        res = c.fetchall()
-        c.close()
-        conn.close()
-        
-        if not res:
+# === SEASONS ===
+# /reset_all starts a new season instead of rewriting every row: it inserts
+# one row into `seasons`. Leaderboard rows carry the season they were last
+# synced in and every read filters on the current one, so rows from older
+# seasons read as zero until the player's next sync overwrites them. Before
+# a row is overwritten its old season's score is copied to
+# `leaderboard_archive`, and archive_seasons() copies everyone else in bulk.
+
+current_season = 1
+
+async def init_seasons(conn):
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS seasons (
+            season SERIAL PRIMARY KEY,
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            archived BOOLEAN NOT NULL DEFAULT FALSE
+        )
+    """)
+    await conn.execute("""
+        INSERT INTO seasons (archived) SELECT FALSE WHERE NOT EXISTS (SELECT 1 FROM seasons)
+    """)
+    await conn.execute("ALTER TABLE leaderboard ADD COLUMN IF NOT EXISTS season INTEGER NOT NULL DEFAULT 1")
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS leaderboard_archive (
+            season INTEGER NOT NULL,
+            id BIGINT NOT NULL,
+            name TEXT,
+            score INTEGER,
+            PRIMARY KEY (season, id)
+        )
+    """)
+
+async def start_new_season():
+    """Begin a new season in O(1); returns (new season, players in the old one)"""
+    global current_season
+    async with db_pool.connection() as conn:
+        cur = await conn.execute("""
+            SELECT coalesce(sum(players), 0)::bigint FROM score_buckets WHERE season = %s
+        """, (current_season,))
+        count = (await cur.fetchone())[0]
+        cur = await conn.execute("INSERT INTO seasons DEFAULT VALUES RETURNING season")
+        current_season = (await cur.fetchone())[0]
+        if worker_sync.enabled:
+            await worker_sync.publish(conn, "season", season=current_season)
+    return current_season, count
+
+async def switch_season(season):
+    """Follow a season started by another worker"""
+    global current_season
+    # Syncs this worker accepted before the reset belong to the old season
+    await score_buffer.flush()
+    current_season = season
+    leaderboard_cache.clear()
+    logger.info("🔄 Now in season %s", season)
+
+async def archive_seasons():
+    """Copy finished seasons into leaderboard_archive, one chunk per transaction"""
+    seasons = await db_fetchall("""
+        SELECT season FROM seasons WHERE NOT archived AND season < %s ORDER BY season
+    """, (current_season,))
+    for (season,) in seasons:
+        last_id = -1
+        while True:
+            async with db_pool.connection() as conn:
+                cur = await conn.execute("""
+                    WITH chunk AS (
+                        SELECT id, name, score FROM leaderboard
+                        WHERE season = %s AND id > %s
+                        ORDER BY id LIMIT %s
+                    ), copied AS (
+                        INSERT INTO leaderboard_archive (season, id, name, score)
+                        SELECT %s, id, name, score FROM chunk
+                        ON CONFLICT DO NOTHING
+                    )
+                    SELECT max(id), count(*) FROM chunk
+                """, (season, last_id, ARCHIVE_BATCH_SIZE, season))
+                max_id, copied = await cur.fetchone()
+            if copied < ARCHIVE_BATCH_SIZE:
+                break
+            last_id = max_id
+            await asyncio.sleep(0)
+        await db_execute("UPDATE seasons SET archived = TRUE WHERE season = %s", (season,))
+        logger.info("📦 Season %s archived", season)
+
+# === RANK INDEX ===
+# `leaderboard_season_score_idx` serves top-N and keyset pages. Exact
+# positions come from `score_buckets`, a histogram of players per season and
+# score bucket kept current by statement-level triggers, so a rank costs one
+# small aggregate plus a count inside a single bucket instead of counting
+# every better player. Buckets are exact below 1024 and 64 per power of two
+# above it.
+
+def score_bucket(score):
+    """Python mirror of the score_bucket() SQL function"""
+    if score < 1024:
+        return score
+    e = score.bit_length() - 1
+    return 1024 + (e - 10) * 64 + ((score >> (e - 6)) & 63)
+
+def score_bucket_upper(bucket):
+    """Exclusive upper score bound of a bucket"""
+    if bucket < 1024:
+        return bucket + 1
+    e, m = divmod(bucket - 1024, 64)
+    return (65 + m) << (e + 4)
+
+async def init_rank_index(conn):
+    await conn.execute("""
+        CREATE INDEX IF NOT EXISTS leaderboard_season_score_idx ON leaderboard (season, score, id)
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS score_buckets (
+            season INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            players BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (season, bucket)
+        )
+    """)
+    await conn.execute("""
+        CREATE OR REPLACE FUNCTION score_bucket(s INTEGER) RETURNS INTEGER
+        LANGUAGE sql IMMUTABLE AS $$
+            SELECT CASE WHEN s < 1024 THEN s ELSE
+                1024 + (length(ltrim(s::bit(32)::text, '0')) - 11) * 64
+                     + ((s >> (length(ltrim(s::bit(32)::text, '0')) - 7)) & 63)
+            END
+        $$
+    """)
+    await conn.execute("""
+        CREATE OR REPLACE FUNCTION score_buckets_apply() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO score_buckets (season, bucket, players)
+                SELECT season, score_bucket(score), count(*) FROM new_rows
+                WHERE score IS NOT NULL GROUP BY 1, 2 ORDER BY 1, 2
+                ON CONFLICT (season, bucket) DO UPDATE SET players = score_buckets.players + EXCLUDED.players;
+            ELSIF TG_OP = 'DELETE' THEN
+                INSERT INTO score_buckets (season, bucket, players)
+                SELECT season, score_bucket(score), -count(*) FROM old_rows
+                WHERE score IS NOT NULL GROUP BY 1, 2 ORDER BY 1, 2
+                ON CONFLICT (season, bucket) DO UPDATE SET players = score_buckets.players + EXCLUDED.players;
+            ELSE
+                INSERT INTO score_buckets (season, bucket, players)
+                SELECT season, bucket, sum(delta) FROM (
+                    SELECT season, score_bucket(score) AS bucket, 1 AS delta FROM new_rows WHERE score IS NOT NULL
+                    UNION ALL
+                    SELECT season, score_bucket(score), -1 FROM old_rows WHERE score IS NOT NULL
+                ) d GROUP BY season, bucket HAVING sum(delta) <> 0 ORDER BY season, bucket
+                ON CONFLICT (season, bucket) DO UPDATE SET players = score_buckets.players + EXCLUDED.players;
+            END IF;
+            RETURN NULL;
+        END $$
+    """)
+    cur = await conn.execute("""
+        SELECT count(*) FROM pg_trigger
+        WHERE tgrelid = 'leaderboard'::regclass AND tgname LIKE 'leaderboard_buckets_%%'
+    """)
+    if (await cur.fetchone())[0] == 3:
+        return
+    # First run: install the triggers and backfill under a lock so no write
+    # lands between the two
+    await conn.execute("LOCK TABLE leaderboard IN SHARE ROW EXCLUSIVE MODE")
+    for op, refs in (("INSERT", "NEW TABLE AS new_rows"),
+                     ("UPDATE", "OLD TABLE AS old_rows NEW TABLE AS new_rows"),
+                     ("DELETE", "OLD TABLE AS old_rows")):
+        name = "leaderboard_buckets_" + op.lower()
+        await conn.execute(f"DROP TRIGGER IF EXISTS {name} ON leaderboard")
+        await conn.execute(f"""
+            CREATE TRIGGER {name} AFTER {op} ON leaderboard
+            REFERENCING {refs}
+            FOR EACH STATEMENT EXECUTE FUNCTION score_buckets_apply()
+        """)
+    await conn.execute("TRUNCATE score_buckets")
+    await conn.execute("""
+        INSERT INTO score_buckets (season, bucket, players)
+        SELECT season, score_bucket(score), count(*) FROM leaderboard
+        WHERE score IS NOT NULL GROUP BY 1, 2
+    """)
+    logger.info("✅ Rank index built")
+
+async def get_player_rank(uid, neighbours=2):
+    """Return (name, score, position, total, above, below) or None.
+
+    Players with equal scores share a position. `above` and `below` list the
+    (name, score) of the nearest players in leaderboard order, closest first.
+    """
+    if uid in score_buffer.pending:
+        await score_buffer.flush()
+    season = current_season
+    async with db_pool.connection() as conn:
+        cur = await conn.execute("""
+            SELECT name, score FROM leaderboard WHERE id = %s AND season = %s
+        """, (uid, season))
+        me = await cur.fetchone()
+        if me is None or me[1] is None:
+            return None
+        name, score = me
+        bucket = score_bucket(score)
+        cur = await conn.execute("""
+            SELECT
+                (SELECT coalesce(sum(players), 0) FROM score_buckets
+                 WHERE season = %s AND bucket > %s)::bigint
+                + (SELECT count(*) FROM leaderboard
+                   WHERE season = %s AND score > %s AND score < %s)
+                + 1,
+                (SELECT coalesce(sum(players), 0) FROM score_buckets WHERE season = %s)::bigint
+        """, (season, bucket, season, score, score_bucket_upper(bucket), season))
+        position, total = await cur.fetchone()
+        cur = await conn.execute("""
+            (SELECT 1, name, score FROM leaderboard
+             WHERE season = %s AND (score, id) > (%s, %s) ORDER BY score, id LIMIT %s)
+            UNION ALL
+            (SELECT -1, name, score FROM leaderboard
+             WHERE season = %s AND (score, id) < (%s, %s) ORDER BY score DESC, id DESC LIMIT %s)
+        """, (season, score, uid, neighbours, season, score, uid, neighbours))
+        rows = await cur.fetchall()
+    above = [(n, s) for side, n, s in rows if side == 1]
+    below = [(n, s) for side, n, s in rows if side == -1]
+    return name, score, position, total, above, below
+
+async def get_leaderboard_page(cursor, forward=True):
+    """Keyset page of LEADERBOARD_SIZE rows after (or before) a (score, id) cursor.
+
+    Returns (rows, has_more) with rows as (id, name, score) in leaderboard
+    order; `has_more` tells whether anything lies beyond the page in the
+    direction of travel.
+    """
+    score, uid = cursor
+    if forward:
+        rows = await db_fetchall("""
+            SELECT id, name, score FROM leaderboard
+            WHERE season = %s AND (score, id) < (%s, %s)
+            ORDER BY score DESC, id DESC
+            LIMIT %s
+        """, (current_season, score, uid, LEADERBOARD_SIZE + 1))
+    else:
+        rows = await db_fetchall("""
+            SELECT id, name, score FROM leaderboard
+            WHERE season = %s AND (score, id) > (%s, %s)
+            ORDER BY score, id
+            LIMIT %s
+        """, (current_season, score, uid, LEADERBOARD_SIZE + 1))
+    has_more = len(rows) > LEADERBOARD_SIZE
+    rows = rows[:LEADERBOARD_SIZE]
+    if not forward:
+        rows.reverse()
+    return rows, has_more
+
+# === TAP BATCHES ===
+# A sync may carry the taps behind it, as base64 of n little-endian uint16
+# gaps (ms since the previous tap, capped at 65535), then n x and n y
+# positions scaled to 0-255 across the face image. The per-tap checks from
+# index.html are rerun here over the whole batch at once.
+
+TapReport = namedtuple('TapReport', 'taps rate interval variance position')
+tap_flags = defaultdict(int)  # layer -> syncs rejected by it
+
+def decode_taps(blob):
+    """(gaps, xs, ys) arrays of a tap batch; ValueError if it is malformed"""
+    raw = base64.b64decode(blob, validate=True)
+    n, rest = divmod(len(raw), 4)
+    if rest or n > TAP_BATCH_MAX:
+        raise ValueError(f"bad tap batch length {len(raw)}")
+    gaps = np.frombuffer(raw, dtype='<u2', count=n)
+    xs = np.frombuffer(raw, dtype=np.uint8, count=n, offset=2 * n)
+    ys = np.frombuffer(raw, dtype=np.uint8, count=n, offset=3 * n)
+    return gaps, xs, ys
+
+def analyze_taps(gaps, xs, ys):
+    """Count how often each client-side layer fires across the batch.
+
+    Every check is evaluated at every tap (or window of taps) with whole-array
+    operations, so the cost is a few passes over the batch however long it is.
+    """
+    n = len(gaps)
+    gaps = gaps.astype(np.int64)
+    ends = np.concatenate(([0], np.cumsum(gaps)))  # tap i happened at ends[i + 1]
+    times = ends[1:]
+
+    # Layer 1: more than MAX_TAPS_PER_SECOND taps in the second ending at a tap,
+    # i.e. the tap that many places back is under 1000 ms older
+    r = MAX_TAPS_PER_SECOND
+    rate = np.count_nonzero(times[r:] - times[:-r] < 1000)
+
+    # Layer 2: taps closer than MIN_TAP_INTERVAL to the one before
+    interval = np.count_nonzero(gaps < MIN_TAP_INTERVAL)
+
+    # Layer 3: windows of PATTERN_CHECK_SIZE taps whose gaps are fast and
+    # near-constant. Exact in integers: variance < V  <=>  k*Σg² - (Σg)² < V*k²
+    k = PATTERN_CHECK_SIZE - 1
+    variance = 0
+    if n >= k:
+        squares = np.concatenate(([0], np.cumsum(gaps * gaps)))
+        total = ends[k:] - ends[:-k]
+        spread = k * (squares[k:] - squares[:-k]) - total * total
+        variance = np.count_nonzero((spread < VARIANCE_THRESHOLD * k * k)
+                                    & (total < VARIANCE_MAX_INTERVAL * k))
+
+    # Layer 4: taps landing on the same spot as the MAX_SAME_POSITION_TAPS before them
+    m = MAX_SAME_POSITION_TAPS
+    position = 0
+    if n > m:
+        same = (xs[1:] == xs[:-1]) & (ys[1:] == ys[:-1])  # tap i + 1 on the spot of tap i
+        run = same[m - 1:].copy()
+        for back in range(1, m):
+            run &= same[m - 1 - back:len(same) - back]
+        position = np.count_nonzero(run)
+
+    return TapReport(n, int(rate), int(interval), int(variance), int(position))
+
+def tap_violations(report):
+    """Layers that fired often enough in the batch to flag the player"""
+    limit = max(TAP_FLAG_MIN_HITS, TAP_FLAG_RATIO * report.taps)
+    return [layer for layer in TapReport._fields[1:] if getattr(report, layer) >= limit]
+
+# === BOOSTS & REFERRALS ===
+# Each is one atomic statement, so concurrent requests can neither spend a
+# boost twice nor credit a referral twice.
+
+async def get_boosts(uid):
+    row = await db_fetchone_atomic("SELECT energy_boosts FROM referrals WHERE user_id = %s", (uid,))
+    return row[0] if row else 0
+
+async def spend_boost(uid):
+    """Use one energy boost; returns the number left, or None if there was none"""
+    row = await db_fetchone_atomic("""
+        UPDATE referrals
+        SET energy_boosts = energy_boosts - 1
+        WHERE user_id = %s AND energy_boosts > 0
+        RETURNING energy_boosts
+    """, (uid,))
+    return row[0] if row else None
+
+async def spend_boost_once(uid, key, now=None):
+    """spend_boost() at most once per idempotency `key`.
+
+    Returns (claimed, remaining): `claimed` is False if the key was used
+    before (nothing is spent again). The key is claimed first, so a
+    concurrent request with the same key waits on it and then finds it taken.
+    """
+    now = time.time() if now is None else now
+    row = await db_fetchone_atomic("""
+        WITH claimed AS (
+            INSERT INTO boost_spends (user_id, key, spent_at)
+            VALUES (%(uid)s, %(key)s, %(now)s)
+            ON CONFLICT DO NOTHING
+            RETURNING user_id
+        ), spent AS (
+            UPDATE referrals
+            SET energy_boosts = energy_boosts - 1
+            WHERE user_id = (SELECT user_id FROM claimed) AND energy_boosts > 0
+            RETURNING energy_boosts
+        )
+        SELECT EXISTS (SELECT 1 FROM claimed), (SELECT energy_boosts FROM spent)
+    """, {'uid': uid, 'key': key, 'now': now})
+    return row[0], row[1]
+
+async def credit_referral(uid, referrer_id, now=None):
+    """Record that `uid` joined through `referrer_id` and reward the referrer.
+
+    Only a user with no referrals row yet counts as new; returns True if
+    the referral was credited.
+    """
+    now = time.time() if now is None else now
+    row = await db_fetchone_atomic("""
+        WITH referred AS (
+            INSERT INTO referrals (user_id, referred_by, energy_boosts, referred_at)
+            VALUES (%(uid)s, %(referrer)s, 0, %(now)s)
+            ON CONFLICT (user_id) DO NOTHING
+            RETURNING referred_by
+        )
+        INSERT INTO referrals (user_id, energy_boosts, total_referrals)
+        SELECT referred_by, 1, 1 FROM referred
+        ON CONFLICT (user_id) DO UPDATE
+        SET energy_boosts = referrals.energy_boosts + 1,
+            total_referrals = referrals.total_referrals + 1
+        RETURNING total_referrals
+    """, {'uid': uid, 'referrer': referrer_id, 'now': now})
+    return row is not None
+
+class BackgroundFlusher:
+    """Runs flush() every `interval` seconds, or sooner after wake()"""
+
+    name = "background"
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    async def flush(self):
+        """Write whatever is pending; returns rows written.
+
+        Subclasses override this. The base class holds nothing, so a
+        flusher that does not override it is a harmless no-op.
+        """
+        return 0
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("❌ %s flush error: %s", self.name, e)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the flush loop and write whatever is still pending"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+class ScoreBuffer(BackgroundFlusher):
+    """Write-behind buffer for score syncs.
+
+    Only the newest score per user is kept. Pending scores are written to
+    `leaderboard` as one multi-row upsert every `interval` seconds, or sooner
+    once `max_pending` users are waiting, so commits scale with the flush
+    rate instead of with how often players press SYNC.
+    """
+
+    # Rows still holding an older season's score are archived before being
+    # overwritten (the CTE reads the pre-update snapshot)
+    UPSERT = """
+        WITH incoming AS ({incoming}), archived AS (
+            INSERT INTO leaderboard_archive (season, id, name, score)
+            SELECT l.season, l.id, l.name, l.score
+            FROM leaderboard l JOIN incoming USING (id)
+            WHERE l.season < %(season)s
+            ON CONFLICT DO NOTHING
+        )
+        INSERT INTO leaderboard (id, name, score, season)
+        SELECT id, name, score, %(season)s FROM incoming
+        ON CONFLICT (id) DO UPDATE
+        SET name = EXCLUDED.name, score = EXCLUDED.score, season = EXCLUDED.season
+        RETURNING id, name, score
+    """
+    INCOMING = """
+        SELECT * FROM unnest(%(ids)s::bigint[], %(names)s::text[], %(scores)s::integer[])
+            AS t(id, name, score)
+    """
+    # Multi-worker mode: workers flush in any order, so write each player's
+    # latest accepted score (from sync_sessions) rather than this worker's
+    INCOMING_SHARED = """
+        SELECT t.id, t.name, coalesce(s.score, t.score)::integer AS score
+        FROM unnest(%(ids)s::bigint[], %(names)s::text[], %(scores)s::integer[]) AS t(id, name, score)
+        LEFT JOIN sync_sessions s ON s.user_id = t.id
+    """
+
+    name = "Score"
+
+    def __init__(self, interval, max_pending, shared=False):
+        super().__init__(interval)
+        self.max_pending = max_pending
+        self.pending = {}
+        self.upsert = self.UPSERT.format(incoming=self.INCOMING_SHARED if shared else self.INCOMING)
+        self._lock = asyncio.Lock()
+
+    def add(self, uid, name, score):
+        self.pending[uid] = (str(name), int(score))
+        if len(self.pending) >= self.max_pending:
+            self.wake()
+
+    async def flush(self):
+        """Write every pending score in one statement; returns rows written"""
+        async with self._lock:
+            if not self.pending:
+                return 0
+            batch, self.pending = self.pending, {}
+            try:
+                async with db_pool.connection() as conn:
+                    cur = await conn.execute(self.upsert, {
+                        'ids': list(batch),
+                        'names': [name for name, _ in batch.values()],
+                        'scores': [score for _, score in batch.values()],
+                        'season': current_season,
+                    })
+                    if worker_sync.enabled:
+                        # Delivered to the other workers when this commits
+                        await worker_sync.publish_scores(conn, await cur.fetchall())
+            except Exception:
+                # Requeue, but never over a newer score that arrived meanwhile
+                for uid, entry in batch.items():
+                    self.pending.setdefault(uid, entry)
+                raise
+            log_sampled("✅ Flushed %s score(s)", len(batch))
+            return len(batch)
+
+score_buffer = ScoreBuffer(SCORE_FLUSH_INTERVAL, SCORE_FLUSH_MAX, shared=MULTI_WORKER)
+
+class SessionTracker(BackgroundFlusher):
+    """Per-user record of the last accepted score, for the score-rate check.
+
+    Each entry is (score, wall-clock time) in an LRU OrderedDict, so a check
+    is O(1) and never touches the database. Entries idle for longer than it
+    takes to earn MAX_SCORE at the maximum rate are dropped (they could no
+    longer reject anything), and the least recently used entries go once
+    `max_users` is reached. Changed entries are persisted to `sync_sessions`
+    in the background and reloaded at startup.
+
+    With `shared` (multi-worker mode) a user's syncs may reach any worker,
+    so each check is instead one conditional upsert on `sync_sessions`,
+    timed by the database clock.
+    """
+
+    name = "Session"
+
+    SHARED_CHECK = """
+        INSERT INTO sync_sessions AS s (user_id, score, synced_at)
+        VALUES (%(uid)s, %(score)s, extract(epoch FROM clock_timestamp()))
+        ON CONFLICT (user_id) DO UPDATE
+        SET score = EXCLUDED.score, synced_at = EXCLUDED.synced_at
+        WHERE EXCLUDED.score + %(spent)s - s.score <= (EXCLUDED.synced_at - s.synced_at + %(grace)s) * %(rate)s
+        RETURNING 1
+    """
+
+    def __init__(self, max_users, max_rate, grace, interval, shared=False):
+        super().__init__(interval)
+        self.shared = shared
+        self.max_users = max_users
+        self.max_rate = max_rate
+        self.grace = grace
+        self.idle_ttl = MAX_SCORE / max_rate + grace
+        self.sessions = OrderedDict()  # uid -> (score, timestamp)
+        self.dirty = set()
+        self.rejected = 0
+        self.loaded = False  # until then, unknown players are looked up one by one
+
+    def check(self, uid, score, now=None, spent=0, tapped=True):
+        """Record `score` if it is reachable since the last sync; False rejects it.
+
+        `spent` is what the player paid for purchases in between, which they
+        must have earned on top of the score gained. Coins only come from
+        taps, so without `tapped` (a sync sending no taps) nothing may have
+        been earned at all.
+        """
+        now = time.time() if now is None else now
+        last = self.sessions.get(uid)
+        if last is not None:
+            last_score, last_time = last
+            rate = self.max_rate if tapped else 0
+            if score + spent - last_score > (now - last_time + self.grace) * rate:
+                self.rejected += 1
+                return False
+            self.sessions.move_to_end(uid)
+        self.sessions[uid] = (score, now)
+        self.dirty.add(uid)
+        self._evict(now)
+        return True
+
+    async def accept(self, uid, score, spent=0, tapped=True):
+        """check() against this worker's sessions, or against everyone's when shared"""
+        if not self.shared:
+            if not self.loaded and uid not in self.sessions:
+                await self._fetch(uid)
+            return self.check(uid, score, spent=spent, tapped=tapped)
+        row = await db_fetchone_atomic(self.SHARED_CHECK, {
+            'uid': uid, 'score': score, 'spent': spent, 'grace': self.grace,
+            'rate': self.max_rate if tapped else 0})
+        if row is None:
+            self.rejected += 1
+            return False
+        return True
+
+    def forget(self, uid):
+        self.sessions.pop(uid, None)
+        self.dirty.discard(uid)
+
+    def _evict(self, now):
+        sessions = self.sessions
+        while sessions:
+            uid, (_, ts) = next(iter(sessions.items()))
+            if len(sessions) <= self.max_users and now - ts <= self.idle_ttl:
+                break
+            sessions.popitem(last=False)
+            self.dirty.discard(uid)
+
+    async def _fetch(self, uid):
+        """One player's persisted session, while load() has not finished"""
+        row = await db_fetchone_atomic("""
+            SELECT score, synced_at FROM sync_sessions WHERE user_id = %s AND synced_at > %s
+        """, (uid, time.time() - self.idle_ttl))
+        if row is not None and uid not in self.sessions:
+            self.sessions[uid] = tuple(row)
+
+    async def load(self):
+        if self.shared:
+            return
+        rows = await db_fetchall("""
+            SELECT user_id, score, synced_at FROM sync_sessions
+            WHERE synced_at > %s
+            ORDER BY synced_at DESC
+            LIMIT %s
+        """, (time.time() - self.idle_ttl, self.max_users))
+        # Sessions fetched or updated while this ran are newer than their rows
+        sessions = OrderedDict((uid, (score, ts)) for uid, score, ts in reversed(rows))
+        for uid, session in self.sessions.items():
+            sessions[uid] = session
+            sessions.move_to_end(uid)
+        self.sessions = sessions
+        self.loaded = True
+        self._evict(time.time())
+        logger.info("✅ Loaded %s sync session(s)", len(rows))
+
+    async def flush(self):
+        if self.shared:
+            # Rows are written as syncs arrive; only expire the stale ones
+            await db_execute("DELETE FROM sync_sessions WHERE synced_at < %s", (time.time() - self.idle_ttl,))
+            return 0
+        if not self.dirty:
+            return 0
+        uids = [uid for uid in self.dirty if uid in self.sessions]
+        self.dirty = set()
+        entries = [self.sessions[uid] for uid in uids]
+        try:
+            async with db_pool.connection() as conn:
+                await conn.execute("""
+                    INSERT INTO sync_sessions (user_id, score, synced_at)
+                    SELECT * FROM unnest(%s::bigint[], %s::bigint[], %s::double precision[])
+                    ON CONFLICT (user_id) DO UPDATE
+                    SET score = EXCLUDED.score, synced_at = EXCLUDED.synced_at
+                """, (uids, [score for score, _ in entries], [ts for _, ts in entries]))
+                await conn.execute("DELETE FROM sync_sessions WHERE synced_at < %s",
+                                   (time.time() - self.idle_ttl,))
+        except Exception:
+            self.dirty.update(uids)
+            raise
+        return len(uids)
+
+session_tracker = SessionTracker(SESSION_MAX_USERS, MAX_TAPS_PER_SECOND * MAX_TAP_POWER,
+                                 SCORE_RATE_GRACE, SESSION_FLUSH_INTERVAL, shared=MULTI_WORKER)
+
+# === PLAYER STATE ===
+# The game economy is held server-side, one `player_state` row per player.
+# A row records the state as of `updated_at`; energy regeneration and boost
+# decay since then are applied when the state is read, so nothing ticks and
+# a row is only written when the player changes something (a sync or a
+# refill). A player without a row gets one from their first sync, seeded
+# with the boosts and cards the game reports (they were bought before the
+# economy moved here). Until then the bot sends the game no state. Like the
+# old /reset_all, a new season resets scores only: rows carry over.
+
+BOOST_LEVELS = {'tap': 'tap_level', 'energy': 'energy_level', 'regen': 'regen_level'}
+
+def decay(level, since, now):
+    """(level, since) after losing a level every BOOST_DECAY_SECONDS since `since`"""
+    cycles = int((now - since) // BOOST_DECAY_SECONDS) if level > 1 and since > 0 else 0
+    if cycles <= 0:
+        return level, since
+    return max(1, level - cycles), since + cycles * BOOST_DECAY_SECONDS
+
+class PlayerState:
+    """One player's energy, boost levels and cards as of `updated_at`"""
+
+    __slots__ = ('energy', 'updated_at', 'tap_level', 'tap_at', 'energy_level',
+                 'regen_level', 'regen_at', 'cards')  # also the column order
+
+    def __init__(self, energy=BASE_ENERGY, updated_at=0.0, tap_level=1, tap_at=0.0,
+                 energy_level=1, regen_level=1, regen_at=0.0, cards=0):
+        self.energy = float(energy)
+        self.updated_at = float(updated_at)
+        self.tap_level = tap_level
+        self.tap_at = float(tap_at)
+        self.energy_level = energy_level
+        self.regen_level = regen_level
+        self.regen_at = float(regen_at)
+        self.cards = cards  # bit n-1 set = card n unlocked
+
+    def row(self):
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def copy(self):
+        return PlayerState(*self.row())
+
+    def max_energy(self):
+        return float(BASE_ENERGY + (self.energy_level - 1) * ENERGY_PER_LEVEL)
+
+    def settle(self, now):
+        """Bring the state forward to `now`: refill energy and decay boosts.
+
+        Tap power and regen lose a level every BOOST_DECAY_SECONDS after they
+        were bought; max energy, which has no timer in the game, decays over
+        the time since the player last changed anything.
+        """
+        elapsed = max(0.0, now - self.updated_at)
+        regen = 1 + self.regen_level * REGEN_PER_LEVEL
+        self.energy = min(self.max_energy(), self.energy + elapsed * regen)
+        self.tap_level, self.tap_at = decay(self.tap_level, self.tap_at, now)
+        self.regen_level, self.regen_at = decay(self.regen_level, self.regen_at, now)
+        self.energy_level = max(1, self.energy_level - int(elapsed // BOOST_DECAY_SECONDS))
+        self.energy = min(self.energy, self.max_energy())
+        self.updated_at = max(self.updated_at, now)
+        return self
+
+    def buy(self, item):
+        """Apply one purchase ('tap', 'energy', 'regen' or 'card:<n>'); returns its cost, or None if not allowed"""
+        if not isinstance(item, str):
+            return None
+        if item in BOOST_LEVELS:
+            level = getattr(self, BOOST_LEVELS[item])
+            if level >= BOOST_LEVEL_CAP_WITHOUT_CARD and not self.cards & 1:
+                return None
+            setattr(self, BOOST_LEVELS[item], level + 1)
+            if item == 'tap':
+                self.tap_at = self.updated_at
+            elif item == 'regen':
+                self.regen_at = self.updated_at
+            return BOOST_COSTS[item] << (level - 1)
+        card = CARD_ITEMS.get(item)
+        if card is not None and not self.cards >> (card - 1) & 1:
+            self.cards |= 1 << (card - 1)
+            return CARD_COSTS[card]
+        return None
+
+    def apply(self, buys):
+        """Apply a sync's purchases in order; total coins spent, or None if any was invalid"""
+        if not isinstance(buys, list) or len(buys) > MAX_BUYS_PER_SYNC:
+            return None
+        spent = 0
+        for item in buys:
+            cost = self.buy(item)
+            if cost is None:
+                return None
+            spent += cost
+        return spent
+
+    def use_energy(self, reported):
+        """Take the client's energy level, which can only be below what regeneration allows"""
+        if isinstance(reported, (int, float)) and not isinstance(reported, bool):
+            self.energy = min(self.energy, max(0.0, float(reported)))
+
+    def refill(self):
+        self.energy = self.max_energy()
+
+    @classmethod
+    def seed(cls, levels, cards, buys, now):
+        """The state a player without a row had before this sync's `buys`.
+
+        `levels` ([tap, energy, regen]) and `cards` (a bitmask) are what the
+        game reports owning, `buys` included. Returns (state, coins the
+        holdings cost from level 1), or None if the report is malformed or
+        not reachable by buying.
+        """
+        if (not isinstance(levels, list) or len(levels) != len(BOOST_LEVELS)
+                or not all(type(level) is int and 1 <= level <= 64 for level in levels)
+                or type(cards) is not int or cards < 0 or cards & ~CARD_MASK):
+            return None
+        levels = dict(zip(BOOST_LEVELS, levels))
+        for item in buys if isinstance(buys, list) else ():
+            if not isinstance(item, str):
+                return None
+            if item in levels:
+                levels[item] -= 1
+            elif item in CARD_ITEMS:
+                cards &= ~(1 << (CARD_ITEMS[item] - 1))
+            else:
+                return None
+        if min(levels.values()) < 1:
+            return None
+        if max(levels.values()) > BOOST_LEVEL_CAP_WITHOUT_CARD and not cards & 1:
+            return None
+        state = cls(updated_at=now, tap_level=levels['tap'], tap_at=now, energy_level=levels['energy'],
+                    regen_level=levels['regen'], regen_at=now, cards=cards)
+        state.refill()
+        cost = sum(BOOST_COSTS[item] * ((1 << (level - 1)) - 1) for item, level in levels.items())
+        cost += sum(price for card, price in CARD_COSTS.items() if cards >> (card - 1) & 1)
+        return state, cost
+
+    def encode(self):
+        """Compact form for the game's URL: times in ms, energy floored, cards as a bitmask"""
+        return ",".join(str(int(value)) for value in (
+            self.updated_at * 1000, self.energy, self.energy_level, self.tap_level,
+            self.tap_at * 1000, self.regen_level, self.regen_at * 1000, self.cards))
+
+class PlayerStates(BackgroundFlusher):
+    """Cache and write-behind store for `player_state`.
+
+    States are loaded at startup into an LRU OrderedDict, and changed ones
+    are written in one multi-row upsert every `interval` seconds. While every row fits in the cache, a player missing from it has
+    no row and costs no query. With `shared` (multi-worker mode)
+    a player's next update may reach another worker, so every read goes to
+    the database and every change is written through at once.
+    """
+
+    name = "PlayerState"
+
+    SELECT = f"""
+        SELECT {', '.join(PlayerState.__slots__)} FROM player_state WHERE user_id = %s
+    """
+    UPSERT = f"""
+        INSERT INTO player_state (user_id, {', '.join(PlayerState.__slots__)})
+        SELECT * FROM unnest(%(ids)s::bigint[], %(energy)s::real[], %(updated_at)s::float8[],
+            %(tap_level)s::int[], %(tap_at)s::float8[], %(energy_level)s::int[],
+            %(regen_level)s::int[], %(regen_at)s::float8[], %(cards)s::int[])
+        ON CONFLICT (user_id) DO UPDATE SET
+            {', '.join(f'{f} = EXCLUDED.{f}' for f in PlayerState.__slots__)}
+        RETURNING user_id
+    """
+
+    def __init__(self, max_users, interval, shared=False):
+        super().__init__(interval)
+        self.shared = shared
+        self.max_users = max_users
+        self.states = OrderedDict()  # uid -> PlayerState as last written or loaded
+        self.pending = {}  # uid -> PlayerState not yet written
+        self.complete = False  # True when no row exists outside the cache
+        self._lock = asyncio.Lock()
+
+    async def get(self, uid, now=None):
+        """The player's state settled to `now`, or None if they have no row yet.
+
+        A copy, so changes only count once saved.
+        """
+        now = time.time() if now is None else now
+        state = self.pending.get(uid) or self.states.get(uid)
+        if state is None:
+            row = None if self.complete else await db_fetchone_atomic(self.SELECT, (uid,))
+            if row is None:
+                return None
+            state = PlayerState(*row)
+            if not self.shared:
+                self._remember(uid, state)
+        elif uid in self.states:
+            self.states.move_to_end(uid)
+        return state.copy().settle(now)
+
+    async def save(self, uid, state):
+        if self.shared:
+            await db_fetchone_atomic(self.UPSERT, self._params({uid: state}))
+            return
+        self.pending[uid] = state
+        self._remember(uid, state)
+
+    def _remember(self, uid, state):
+        self.states[uid] = state
+        self.states.move_to_end(uid)
+        while len(self.states) > self.max_users:
+            self.states.popitem(last=False)
+            self.complete = False
+
+    async def load(self):
+        if self.shared:
+            return
+        rows = await db_fetchall(f"""
+            SELECT user_id, {', '.join(PlayerState.__slots__)} FROM player_state
+            ORDER BY updated_at DESC
+            LIMIT %s
+        """, (self.max_users + 1,))
+        # States read or saved while this ran are newer than their rows
+        states = OrderedDict((uid, PlayerState(*row)) for uid, *row in reversed(rows[:self.max_users]))
+        for uid, state in self.states.items():
+            states[uid] = state
+            states.move_to_end(uid)
+        self.states = states
+        self.complete = len(rows) <= self.max_users
+        while len(self.states) > self.max_users:
+            self.states.popitem(last=False)
+            self.complete = False
+        logger.info("✅ Loaded %s player state(s)", len(self.states))
+
+    def clear(self):
+        """Forget everything (the table was emptied)"""
+        self.states.clear()
+        self.pending.clear()
+        self.complete = not self.shared
+
+    @staticmethod
+    def _params(batch):
+        rows = [state.row() for state in batch.values()]
+        params = {field: list(column) for field, column in zip(PlayerState.__slots__, zip(*rows))}
+        params['ids'] = list(batch)
+        return params
+
+    async def flush(self):
+        async with self._lock:
+            if not self.pending:
+                return 0
+            batch, self.pending = self.pending, {}
+            try:
+                await db_execute(self.UPSERT, self._params(batch))
+            except Exception:
+                for uid, state in batch.items():
+                    self.pending.setdefault(uid, state)
+                raise
+            return len(batch)
+
+player_states = PlayerStates(PLAYER_STATE_MAX_USERS, PLAYER_STATE_FLUSH_INTERVAL, shared=MULTI_WORKER)
+
+class LeaderboardCache:
+    """Process-local top-K of the `leaderboard` table.
+
+    Holds the best `size` players (ordered by score, then id, both
+    descending) plus the rendered top-`shown` text. Accepted scores are
+    applied with update(), so /leaderboard and the post-sync reply need no
+    query and only re-render when the visible top changes. Invariant: any
+    player outside the cache ranks below the last cached entry, so a player
+    who drops below it is evicted; if too few entries remain to fill the
+    board, the next read reloads from the table.
+    """
+
+    def __init__(self, size, shown):
+        self.size = size
+        self.shown = shown
+        self.players = {}      # uid -> (name, score)
+        self.order = []        # (-score, -uid), best first
+        self.complete = False  # True when no row exists outside the cache
+        self.loaded = False
+        self._text = None
+        self._loading = None   # updates seen while a load is in flight
+        self._load_lock = asyncio.Lock()
+
+    async def load(self):
+        """(Re)load the top-K from the table, including unflushed scores"""
+        async with self._load_lock:
+            if self.loaded:
+                return
+            self._loading = {}
+            try:
+                # Everything accepted so far is in the table after this,
+                # everything accepted from now on is recorded in _loading
+                await score_buffer.flush()
+                rows = await db_fetchall("""
+                    SELECT id, name, score FROM leaderboard
+                    WHERE season = %s
+                    ORDER BY score DESC, id DESC
+                    LIMIT %s
+                """, (current_season, self.size))
+                self.players = {uid: (name, score) for uid, name, score in rows}
+                self.order = sorted((-score, -uid) for uid, _, score in rows)
+                self.complete = len(rows) < self.size
+                self._text = None
+                self.loaded = True
+                for uid, (name, score) in self._loading.items():
+                    self.update(uid, name, score)
+            finally:
+                self._loading = None
+        logger.info("✅ Leaderboard cache loaded (%s players)", len(self.players))
+
+    def invalidate(self):
+        self.loaded = False
+        self.players = {}
+        self.order = []
+        self._text = None
+
+    def clear(self):
+        """A new season has started: the board is known to be empty"""
+        self.players = {}
+        self.order = []
+        self.complete = True
+        self.loaded = True
+        self._text = None
+
+    def update(self, uid, name, score):
+        """Apply an accepted score"""
+        if self._loading is not None:
+            self._loading[uid] = (name, score)
+        if not self.loaded:
+            return
+        touched_top = False
+        if uid in self.players:
+            old_key = (-self.players.pop(uid)[1], -uid)
+            pos = bisect_left(self.order, old_key)
+            del self.order[pos]
+            touched_top = pos < self.shown
+        key = (-score, -uid)
+        if self.complete or (self.order and key < self.order[-1]):
+            self.players[uid] = (name, score)
+            insort(self.order, key)
+            touched_top = touched_top or bisect_left(self.order, key) < self.shown
+            if len(self.order) > self.size:
+                _, worst = self.order.pop()
+                del self.players[-worst]
+                self.complete = False
+        if touched_top:
+            self._text = None
+        if not self.complete and len(self.order) < self.shown:
+            self.invalidate()
+
+    def render(self):
+        if self._text is None:
+            self._text = self._build_text()
+        return self._text
+
+    def _build_text(self):
+        if not self.order:
             return "🏆 No scores yet! Be the first!"
         
         leaderboard_text = "🏆 Global Leaderboard 🏆\n\n"
         medals = ["🥇", "🥈", "🥉"]
         
-        for i, row in enumerate(res):
+        for i, (_, uid) in enumerate(self.order[:self.shown]):
+            name, score = self.players[-uid]
             medal = medals[i] if i < 3 else str(i+1) + "."
-            leaderboard_text += medal + " " + row[0] + ": " + "{:,}".format(row[1]) + "\n"
+            leaderboard_text += medal + " " + name + ": " + "{:,}".format(score) + "\n"
         
         return leaderboard_text
+
+leaderboard_cache = LeaderboardCache(LEADERBOARD_CACHE_SIZE, LEADERBOARD_SIZE)
+
+async def get_rank():
+    try:
+        if not leaderboard_cache.loaded:
+            await leaderboard_cache.load()
+        return leaderboard_cache.render()
     except Exception as e:
         logger.error("❌ Leaderboard error: %s", e)
         return "❌ Error loading leaderboard"
 
+# === REFERRAL GRAPH ===
+
+class ReferralGraph(BackgroundFlusher):
+    """In-memory index of the referral tree (`referrals.referred_by` edges).
+
+    Loaded in bulk at startup and extended by every credited /start, so the
+    top inviters, tree sizes and farm checks need no recursive SQL. A user
+    has one referrer at most and is only credited while new (a leaf), so
+    the edges form a forest and a credit only has to bump the tree size and
+    height of the new user's ancestors. Referrals from the last
+    `farm_window` seconds are counted per referrer along with how many have
+    synced a score this season, and a referrer with `farm_min_fresh` of them, mostly
+    idle, is a suspected farm.
+
+    With `shared` (multi-worker mode) credited referrals are announced
+    through WorkerSync, and flush() picks up activity synced on other
+    workers.
+    """
+
+    name = "Referral graph"
+    LOAD_CHUNK = 10000
+
+    def __init__(self, top_size, farm_window, farm_min_fresh, farm_idle_ratio, interval, shared=False):
+        super().__init__(interval)
+        self.shared = shared
+        self.top_size = top_size
+        self.farm_window = farm_window
+        self.farm_min_fresh = farm_min_fresh
+        self.farm_idle_ratio = farm_idle_ratio
+        self._loading = False
+        self._stale = False  # invalidated while loading: load() goes again
+        self._lock = asyncio.Lock()
+        self._reset()
+
+    def invalidate(self):
+        if self._loading:
+            # The pass in flight may have missed what made us stale, and
+            # resetting under it would leave it indexing empty maps
+            self._stale = True
+            return
+        self._reset()
+
+    def _reset(self):
+        self.loaded = False
+        self.parent = {}                   # uid -> referrer
+        self.children = defaultdict(list)  # referrer -> referred uids
+        self.size = {}                     # referrer -> users in their tree
+        self.height = {}                   # referrer -> levels in their tree
+        self.recent = deque()              # (referred_at, uid) within farm_window, oldest first
+        self.recent_users = set()          # the uids in `recent`
+        self.active = set()                # those of them with a score
+        self.fresh = {}                    # referrer -> [their referrals in `recent`, idle ones]
+        self.top = []                      # (-referrals, uid), best first
+        self._text = None
+
+    async def load(self):
+        """(Re)build the index from `referrals`, streamed through a server-side cursor"""
+        async with self._lock:
+            marked = set()  # active players found by every pass, kept if one goes stale
+            while not self.loaded:
+                await self._load(marked)
+        logger.info("✅ Referral graph loaded (%s referrals)", len(self.parent))
+
+    async def _load(self, marked):
+        self._reset()
+        self.active = marked
+        self._stale = False
+        self._loading = True  # credits and syncs meanwhile are recorded as they come
+        try:
+            parent, children, recent = self.parent, self.children, self.recent
+            async with db_pool.connection() as conn:
+                cur = conn.cursor(name="referral_graph_load")
+                try:
+                    await cur.execute("""
+                        SELECT r.user_id, r.referred_by, r.referred_at, l.score > 0
+                        FROM referrals r LEFT JOIN leaderboard l ON l.id = r.user_id AND l.season = %s
+                        WHERE r.referred_by IS NOT NULL
+                    """, (current_season,), binary=True)
+                    cutoff = time.time() - self.farm_window
+                    while True:
+                        rows = await cur.fetchmany(self.LOAD_CHUNK)
+                        if not rows:
+                            break
+                        for uid, referrer, referred_at, scored in rows:
+                            if uid in parent:
+                                continue
+                            parent[uid] = referrer
+                            children[referrer].append(uid)
+                            if referred_at is not None and referred_at >= cutoff:
+                                recent.append((referred_at, uid))
+                                if scored:
+                                    self.active.add(uid)
+                finally:
+                    await cur.close()
+            if self._stale:
+                return  # load() goes again, with the activity marked so far
+            self._index()
+            self.loaded = True
+        finally:
+            self._loading = False
+
+    def _index(self):
+        """Work out everything derived from the edges once they are all in"""
+        parent, children = self.parent, self.children
+        # Referrers breadth-first from the roots, so every tree can be sized bottom-up
+        order = [uid for uid in children if uid not in parent]
+        reached = 0
+        for uid in order:
+            refs = children[uid]
+            reached += len(refs)
+            order.extend(filter(children.__contains__, refs))
+        if reached < len(parent):
+            # Only rows edited by hand can form a cycle: leave them out
+            keep = set(order)
+            for uid in [uid for uid in children if uid not in keep]:
+                for child in children.pop(uid):
+                    del parent[child]
+            logger.warning("⚠️ Referral cycles left out of the graph")
+        size, height = self.size, self.height
+        for uid in reversed(order):
+            refs = children[uid]
+            inner = [child for child in refs if child in size]
+            size[uid] = len(refs) + sum(map(size.__getitem__, inner))
+            height[uid] = 1 + max(map(height.__getitem__, inner), default=0)
+        self.recent = deque(sorted(entry for entry in self.recent if entry[1] in parent))
+        self.active.intersection_update(uid for _, uid in self.recent)
+        for _, uid in self.recent:
+            self._fresh(uid, 1)
+        self.top = heapq.nsmallest(self.top_size, ((-len(refs), uid) for uid, refs in children.items()))
+
+    def _fresh(self, uid, delta):
+        """Count `uid` in (delta 1) or out of (-1) its referrer's recent referrals"""
+        referrer = self.parent[uid]
+        counts = self.fresh.setdefault(referrer, [0, 0])
+        counts[0] += delta
+        if uid not in self.active:
+            counts[1] += delta
+        if delta > 0:
+            self.recent_users.add(uid)
+        else:
+            self.recent_users.discard(uid)
+            self.active.discard(uid)
+        if not counts[0]:
+            del self.fresh[referrer]
+
+    def _expire(self, now):
+        cutoff = now - self.farm_window
+        recent = self.recent
+        while recent and recent[0][0] < cutoff:
+            _, uid = recent.popleft()
+            if uid in self.recent_users:
+                self._fresh(uid, -1)
+
+    def add(self, uid, referrer, referred_at):
+        """Apply a credited referral"""
+        if not (self.loaded or self._loading) or uid in self.parent:
+            return
+        self.parent[uid] = referrer
+        refs = self.children[referrer]
+        refs.append(uid)
+        self.recent.append((referred_at, uid))
+        if not self.loaded:
+            return  # indexed at the end of load()
+        self._fresh(uid, 1)
+        node, levels = referrer, 1
+        while node is not None:
+            self.size[node] = self.size.get(node, 0) + 1
+            if self.height.get(node, 0) < levels:
+                self.height[node] = levels
+            node = self.parent.get(node)
+            levels += 1
+        self._promote(referrer, len(refs))
+
+    def _promote(self, referrer, count):
+        """Keep `top` exact: referral counts only ever grow by one"""
+        top = self.top
+        key = (-count, referrer)
+        if (-(count - 1), referrer) in top:
+            top.remove((-(count - 1), referrer))
+        elif len(top) >= self.top_size and key > top[-1]:
+            return
+        insort(top, key)
+        del top[self.top_size:]
+        self._text = None
+
+    async def record(self, uid, referrer, referred_at):
+        """add() here and, in multi-worker mode, on every other worker"""
+        self.add(uid, referrer, referred_at)
+        if worker_sync.enabled:
+            await worker_sync.announce("referral", uid=uid, referrer=referrer, at=referred_at)
+
+    def mark_active(self, uid):
+        """`uid` synced a score this season"""
+        if self._loading:
+            self.active.add(uid)  # kept by load() if a recent referral
+        elif uid in self.recent_users and uid not in self.active:
+            self.active.add(uid)
+            self.fresh[self.parent[uid]][1] -= 1
+
+    def referrals(self, uid):
+        return len(self.children.get(uid, ()))
+
+    def tree(self, uid):
+        """(users referred directly or indirectly by `uid`, levels of the tree below them)"""
+        return self.size.get(uid, 0), self.height.get(uid, 0)
+
+    def farms(self, now=None):
+        """Suspected referral farms as (referrer, fresh referrals, idle ones), worst first"""
+        self._expire(time.time() if now is None else now)
+        suspects = [(referrer, fresh, idle) for referrer, (fresh, idle) in self.fresh.items()
+                    if fresh >= self.farm_min_fresh and idle >= fresh * self.farm_idle_ratio]
+        suspects.sort(key=lambda farm: (-farm[2], -farm[1], farm[0]))
+        return suspects
+
+    async def render(self):
+        """The /inviters text, rebuilt only when the top changes"""
+        if self._text is None:
+            top = list(self.top)
+            rows = await db_fetchall("SELECT id, name FROM leaderboard WHERE id = ANY(%s)",
+                                     ([uid for _, uid in top],))
+            if top == self.top:
+                self._text = self._build_text(top, dict(rows))
+            else:
+                return self._build_text(top, dict(rows))
+        return self._text
+
+    @staticmethod
+    def _build_text(top, names):
+        if not top:
+            return "🎁 No referrals yet! Be the first with /invite"
+        
+        text = "🎁 Top Inviters 🎁\n\n"
+        medals = ["🥇", "🥈", "🥉"]
+        
+        for i, (count, uid) in enumerate(top):
+            medal = medals[i] if i < 3 else str(i+1) + "."
+            text += f"{medal} {names.get(uid) or 'Anonymous'}: {-count:,} friend(s)\n"
+        
+        return text
+
+    def start(self):
+        if self.shared:
+            super().start()
+
+    async def flush(self):
+        """Multi-worker mode: mark fresh referrals that synced a score on another worker"""
+        if not (self.shared and self.loaded):
+            return 0
+        self._expire(time.time())
+        idle = [uid for uid in self.recent_users if uid not in self.active]
+        if not idle:
+            return 0
+        rows = await db_fetchall("""
+            SELECT id FROM leaderboard WHERE id = ANY(%s) AND season = %s AND score > 0
+        """, (idle, current_season))
+        for (uid,) in rows:
+            self.mark_active(uid)
+        return len(rows)
+
+referral_graph = ReferralGraph(TOP_INVITERS_SIZE, REFERRAL_FARM_WINDOW, REFERRAL_FARM_MIN_FRESH,
+                               REFERRAL_FARM_IDLE_RATIO, REFERRAL_REFRESH_INTERVAL, shared=MULTI_WORKER)
+
+class CheaterQueue(BackgroundFlusher):
+    """Batches cheater flags and merges repeats from the same user.
+
+    Repeated flags for one user collapse into a single pending row whose
+    flag count accumulates while the reason and suspicious_count keep the
+    latest values. Pending rows are upserted together every `interval`
+    seconds. At most `max_pending` distinct users are held; flags for
+    users not already pending are dropped (and counted) beyond that, so a
+    flood of new accounts cannot exhaust memory.
+    """
+
+    name = "Cheater"
+
+    UPSERT = """
+        INSERT INTO cheaters (user_id, username, flag_count, last_flag_reason, suspicious_count)
+        SELECT * FROM unnest(%s::bigint[], %s::text[], %s::integer[], %s::text[], %s::integer[])
+        ON CONFLICT (user_id) DO UPDATE 
+        SET flag_count = cheaters.flag_count + EXCLUDED.flag_count,
+            last_flag_reason = EXCLUDED.last_flag_reason,
+            suspicious_count = EXCLUDED.suspicious_count
+    """
+
+    def __init__(self, interval, max_pending):
+        super().__init__(interval)
+        self.max_pending = max_pending
+        self.pending = {}  # uid -> [username, flags, reason, suspicious_count]
+        self.dropped = 0
+        self._lock = asyncio.Lock()
+
+    def add(self, uid, username, reason, suspicious_count, flags=1):
+        entry = self.pending.get(uid)
+        if entry is None:
+            if len(self.pending) >= self.max_pending:
+                self.dropped += flags
+                self.wake()
+                return False
+            self.pending[uid] = [username, flags, reason, suspicious_count]
+        else:
+            entry[1] += flags
+            entry[2] = reason
+            entry[3] = suspicious_count
+        return True
+
+    async def flush(self):
+        async with self._lock:
+            if not self.pending:
+                return 0
+            batch, self.pending = self.pending, {}
+            entries = list(batch.values())
+            try:
+                await db_execute(self.UPSERT, (
+                    list(batch),
+                    [e[0] for e in entries],
+                    [e[1] for e in entries],
+                    [e[2] for e in entries],
+                    [e[3] for e in entries],
+                ))
+            except Exception:
+                # Requeue, folding in anything flagged meanwhile
+                for uid, (username, flags, reason, susp) in batch.items():
+                    newer = self.pending.get(uid)
+                    if newer is None:
+                        self.pending[uid] = [username, flags, reason, susp]
+                    else:
+                        newer[1] += flags
+                raise
+            logger.info("📝 Logged %s cheater(s)", len(batch))
+            return len(batch)
+
+cheater_queue = CheaterQueue(CHEATER_FLUSH_INTERVAL, CHEATER_QUEUE_MAX)
+
 def log_cheater(uid, username, reason, suspicious_count):
-    """Log a cheater to the database"""
+    """Queue a cheater flag for the next batched write"""
     try:
-        conn = psycopg.connect(DATABASE_URL)
-        c = conn.cursor()
-        c.execute("""
-            INSERT INTO cheaters (user_id, username, flag_count, last_flag_reason, suspicious_count)
-            VALUES (%s, %s, 1, %s, %s)
-            ON CONFLICT (user_id) DO UPDATE 
-            SET flag_count = cheaters.flag_count + 1,
-                last_flag_reason = %s,
-                suspicious_count = %s
-        """, (uid, str(username), reason, suspicious_count, reason, suspicious_count))
-        conn.commit()
-        c.close()
-        conn.close()
-        logger.info("📝 Cheater logged: User %s - Reason: %s", uid, reason)
-    except Exception as e:
-        logger.error("❌ Error logging cheater: %s", e)
+        suspicious_count = int(suspicious_count)
+    except (TypeError, ValueError):
+        suspicious_count = 0
+    if cheater_queue.add(uid, str(username), reason, suspicious_count):
+        logger.info("📝 Cheater queued: User %s - Reason: %s", uid, reason)
+    else:
+        logger.warning("⚠️ Cheater queue full, dropped flag for user %s", uid)
+
+class WorkerSync(BackgroundFlusher):
+    """Keeps the in-memory state of several bot workers in step (multi-worker mode).
+
+    Every worker LISTENs on one channel. A score flush NOTIFYs the top of
+    the rows it wrote, so each worker's leaderboard cache sees every
+    worker's syncs, /reset_all NOTIFYs the new season and /start each
+    credited referral. Notifications are
+    sent inside the writing transaction, so they arrive only once the data
+    is committed. After (re)connecting, a worker reloads what it may have
+    missed. flush() expires old shared throttle buckets.
+    """
+
+    name = "Worker sync"
+    CHANNEL = "bert_workers"
+    MAX_PAYLOAD = 7000  # NOTIFY payloads must stay under 8000 bytes
+
+    def __init__(self, enabled, interval):
+        super().__init__(interval)
+        self.enabled = enabled
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.received = 0
+        self._listener = None
+
+    async def publish(self, conn, event, **data):
+        payload = json.dumps({'from': self.worker_id, 'event': event, **data})
+        await conn.execute("SELECT pg_notify(%s, %s)", (self.CHANNEL, payload))
+
+    async def announce(self, event, **data):
+        """publish() on its own transaction, for changes already committed"""
+        async with db_pool.connection() as conn:
+            await self.publish(conn, event, **data)
+
+    async def publish_scores(self, conn, rows):
+        """Announce written (id, name, score) rows that could enter a top-K cache"""
+        # Only the batch's best LEADERBOARD_CACHE_SIZE can end up in anyone's cache
+        rows = sorted(rows, key=lambda r: (r[2], r[0]), reverse=True)[:LEADERBOARD_CACHE_SIZE]
+        chunk, size = [], 0
+        for row in rows:
+            entry = [row[0], row[1], row[2]]
+            entry_size = len(json.dumps(entry, ensure_ascii=False).encode())
+            if chunk and size + entry_size > self.MAX_PAYLOAD:
+                await self.publish(conn, "scores", scores=chunk)
+                chunk, size = [], 0
+            chunk.append(entry)
+            size += entry_size + 1
+        if chunk:
+            await self.publish(conn, "scores", scores=chunk)
 
+    async def handle(self, message):
+        if message.get('from') == self.worker_id:
+            return
+        self.received += 1
+        event = message.get('event')
+        if event == "scores":
+            for uid, name, score in message['scores']:
+                leaderboard_cache.update(uid, name, score)
+        elif event == "season":
+            await switch_season(message['season'])
+        elif event == "referral":
+            referral_graph.add(message['uid'], message['referrer'], message['at'])
+
+    async def resync(self):
+        """Catch up on anything announced while this worker was not listening"""
+        row = await db_fetchone("SELECT max(season) FROM seasons")
+        if row[0] != current_season:
+            await switch_season(row[0])
+        leaderboard_cache.invalidate()
+        referral_graph.invalidate()
+
+    async def _listen(self):
+        while True:
+            try:
+                async with await AsyncConnection.connect(DATABASE_URL, autocommit=True) as conn:
+                    await conn.execute(f"LISTEN {self.CHANNEL}")
+                    await self.resync()
+                    logger.info("📡 Listening for other workers as %s", self.worker_id)
+                    async for notify in conn.notifies():
+                        try:
+                            await self.handle(json.loads(notify.payload))
+                        except Exception as e:
+                            logger.error("❌ Bad worker notification: %s", e)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("❌ Worker listener error: %s (reconnecting)", e)
+                await asyncio.sleep(5)
+
+    async def flush(self):
+        refill = max(burst / rate for rate, burst in THROTTLE_LIMITS.values())
+        await db_execute("""
+            DELETE FROM throttle_buckets WHERE updated_at < extract(epoch FROM clock_timestamp()) - %s
+        """, (refill,))
+
+    def start(self):
+        if not self.enabled:
+            return
+        super().start()
+        self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if not self.enabled:
+            return
+        if self._listener:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        await super().stop()
+
+worker_sync = WorkerSync(MULTI_WORKER, SESSION_FLUSH_INTERVAL)
+
+class Broadcast:
+    """Progress of one /broadcast: messages queued and their outcomes"""
+
+    def __init__(self):
+        self.queued = 0
+        self.outcomes = defaultdict(int)
+        self.fed = False
+        self.finished = asyncio.Event()
+
+    def done(self, outcome):
+        self.outcomes[outcome] += 1
+        self._check()
+
+    def close(self):
+        """Every recipient has been queued"""
+        self.fed = True
+        self._check()
+
+    def _check(self):
+        if self.fed and sum(self.outcomes.values()) >= self.queued:
+            self.finished.set()
+
+class SendQueue:
+    """Outbound messages, sent in the background within Telegram's flood limits.
+
+    Handlers call send() and return at once, so a burst never holds up an
+    update (or a DB connection) behind the Bot API. Messages to one chat go
+    out in order, one at a time, and no faster than a per-chat token bucket
+    (`chat_rate` per second, bursts of `chat_burst`) allows; across all
+    chats sends are spaced to at most `rate` per second. A RetryAfter from
+    Telegram pauses every send for the time it asks and the message is
+    retried; network errors are retried up to `max_attempts` times.
+
+    Broadcast messages wait in a bounded queue of their own and are only
+    taken when no reply is due, so they use whatever capacity replies
+    leave free. Each chat holds at most `chat_size` waiting messages: a chat
+    flooding the bot with updates loses its oldest unsent replies instead
+    of growing the queue without limit.
+    """
+
+    def __init__(self, rate, chat_rate, chat_burst, concurrency, max_attempts, bulk_size, chat_size):
+        self.bot = None
+        self.interval = 1 / rate
+        self.chat_interval = 1 / chat_rate
+        self.chat_tolerance = (chat_burst - 1) / chat_rate
+        self.max_attempts = max_attempts
+        self.chat_size = chat_size
+        self.chats = {}              # chat_id -> deque of [kwargs, attempts, broadcast]
+        self.due = []                # heap of (not_before, seq, chat_id), one per waiting chat
+        self.chat_tat = OrderedDict()  # chat_id -> theoretical arrival time (GCRA)
+        self.in_flight = set()
+        self.bulk = asyncio.Queue(bulk_size)
+        self.next_send = 0.0
+        self.paused_until = 0.0
+        self.outcomes = defaultdict(int)  # sent / blocked / failed / dropped
+        self.retried = 0
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._slots = asyncio.Semaphore(concurrency)
+        self._task = None
+
+    def send(self, chat_id, text, **kwargs):
+        """Queue a send_message call"""
+        kwargs.update(chat_id=chat_id, text=text)
+        self._append(chat_id, [kwargs, 0, None])
+
+    async def send_bulk(self, chat_id, text, broadcast):
+        """Queue a broadcast message, waiting while the broadcast queue is full"""
+        broadcast.queued += 1
+        await self.bulk.put((chat_id, [{'chat_id': chat_id, 'text': text}, 0, broadcast]))
+        self._idle.clear()
+        self._wakeup.set()
+
+    def cancel_bulk(self):
+        """Drop every broadcast message not yet taken; returns how many"""
+        dropped = 0
+        while not self.bulk.empty():
+            _, (_, _, broadcast) = self.bulk.get_nowait()
+            broadcast.done("cancelled")
+            dropped += 1
+        self._check_idle()
+        return dropped
+
+    def pending(self):
+        return sum(len(q) for q in self.chats.values())
+
+    def _append(self, chat_id, item):
+        queue = self.chats.get(chat_id)
+        if queue is None:
+            queue = self.chats[chat_id] = deque()
+        elif len(queue) >= self.chat_size:
+            _, _, broadcast = queue.popleft()
+            self.outcomes["dropped"] += 1
+            if broadcast:
+                broadcast.done("dropped")
+        queue.append(item)
+        self._idle.clear()
+        if len(queue) == 1 and chat_id not in self.in_flight:
+            self._schedule(chat_id)
+
+    def _schedule(self, chat_id):
+        """Put a chat on the heap for the earliest time its bucket allows a send"""
+        now = time.monotonic()
+        not_before = max(now, self.chat_tat.get(chat_id, now) - self.chat_tolerance)
+        heapq.heappush(self.due, (not_before, next(self._seq), chat_id))
+        self._wakeup.set()
+
+    def _take_chat_slot(self, chat_id, now):
+        tat = max(self.chat_tat.pop(chat_id, now), now)
+        self.chat_tat[chat_id] = tat + self.chat_interval
+        # Buckets that have refilled completely carry no state, forget them
+        while self.chat_tat:
+            oldest, oldest_tat = next(iter(self.chat_tat.items()))
+            if oldest_tat > now:
+                break
+            del self.chat_tat[oldest]
+
+    async def _next_chat(self):
+        """Wait for the global rate limit and a chat whose turn has come"""
+        while True:
+            now = time.monotonic()
+            start = max(self.next_send, self.paused_until)
+            reply_due = self.due and self.due[0][0] <= now
+            if reply_due and start <= now:
+                _, _, chat_id = heapq.heappop(self.due)
+                self.next_send = max(self.next_send, now) + self.interval
+                self._take_chat_slot(chat_id, now)
+                return chat_id
+            if not reply_due and not self.bulk.empty():
+                chat_id, item = self.bulk.get_nowait()
+                self._append(chat_id, item)
+                continue
+            
+            self._wakeup.clear()
+            wake_at = max(start, self.due[0][0]) if self.due else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), None if wake_at is None else wake_at - now)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run(self):
+        while True:
+            await self._slots.acquire()
+            try:
+                chat_id = await self._next_chat()
+            except BaseException:
+                self._slots.release()
+                raise
+            item = self.chats[chat_id].popleft()
+            self.in_flight.add(chat_id)
+            spawn(self._deliver(chat_id, item))
+
+    async def _deliver(self, chat_id, item):
+        kwargs, attempts, broadcast = item
+        outcome = None
+        try:
+            await self.bot.send_message(**kwargs)
+            outcome = "sent"
+        except RetryAfter as e:
+            delay = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            self.retried += 1
+            self.chats[chat_id].appendleft(item)
+            logger.warning("⏳ Flood limit hit, pausing sends for %ss", delay)
+        except Forbidden:
+            outcome = "blocked"  # user blocked the bot
+        except BadRequest as e:
+            outcome = "failed"
+            logger.error("❌ Send to %s rejected: %s", chat_id, e)
+        except NetworkError as e:
+            item[1] = attempts + 1
+            if item[1] < self.max_attempts:
+                self.retried += 1
+                self.chats[chat_id].appendleft(item)
+            else:
+                outcome = "failed"
+                logger.error("❌ Send to %s failed after %s attempts: %s", chat_id, item[1], e)
+        except Exception as e:
+            outcome = "failed"
+            logger.error("❌ Send to %s failed: %s", chat_id, e)
+        finally:
+            self.in_flight.discard(chat_id)
+            self._slots.release()
+            if self.chats[chat_id]:
+                self._schedule(chat_id)
+            else:
+                del self.chats[chat_id]
+            if outcome:
+                self.outcomes[outcome] += 1
+                if broadcast:
+                    broadcast.done(outcome)
+            self._check_idle()
+
+    def _check_idle(self):
+        if not self.chats and self.bulk.empty():
+            self._idle.set()
+
+    def start(self, bot):
+        self.bot = bot
+        self._task = asyncio.create_task(self._run())
+
+    async def drain(self, timeout=None):
+        """Wait until nothing is queued or in flight; False on timeout"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def stop(self, timeout):
+        """Stop taking broadcasts, give queued replies `timeout` seconds, then stop"""
+        self.cancel_bulk()
+        if not await self.drain(timeout):
+            logger.warning("⚠️ %s message(s) unsent at shutdown", self.pending())
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+send_queue = SendQueue(SEND_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST, SEND_CONCURRENCY,
+                       SEND_MAX_ATTEMPTS, BROADCAST_BUFFER, SEND_CHAT_QUEUE)
+
+def reply(update: Update, text, **kwargs):
+    """Queue a message to the chat an update came from"""
+    send_queue.send(update.effective_chat.id, text, **kwargs)
+
+def play_keyboard(state=None):
+    """The PLAY button, opening the game with the player's state in its URL"""
+    url = GITHUB_URL if state is None else f"{GITHUB_URL}?state={state.encode()}"
+    return ReplyKeyboardMarkup([[KeyboardButton(text="🕹️ PLAY BERT", web_app=WebAppInfo(url=url))]],
+                               resize_keyboard=True)
+
+@instrumented("start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info("📩 /start from user %s", update.effective_user.id)
+    log_sampled("📩 /start from user %s", update.effective_user.id)
     user_id = update.effective_user.id
     
     # Check for referral code
@@ -136,60 +2432,42 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             try:
                 referrer_id = int(ref_code.replace('ref_', ''))
                 if referrer_id != user_id:  # Can't refer yourself
-                    # Check if user is new (not already in referrals table)
-                    conn = psycopg.connect(DATABASE_URL)
-                    c = conn.cursor()
-                    c.execute("SELECT user_id FROM referrals WHERE user_id = %s", (user_id,))
-                    existing = c.fetchone()
-                    
-                    if not existing:
-                        # New user - track referral
-                        c.execute("""
-                            INSERT INTO referrals (user_id, referred_by, energy_boosts) 
-                            VALUES (%s, %s, 0)
-                        """, (user_id, referrer_id))
-                        
-                        # Give referrer a reward
-                        c.execute("""
-                            INSERT INTO referrals (user_id, energy_boosts, total_referrals)
-                            VALUES (%s, 1, 1)
-                            ON CONFLICT (user_id) DO UPDATE 
-                            SET energy_boosts = referrals.energy_boosts + 1,
-                                total_referrals = referrals.total_referrals + 1
-                        """, (referrer_id,))
-                        
-                        conn.commit()
+                    # New users only: credited at most once, however many /start arrive at once
+                    now = time.time()
+                    if await credit_referral(user_id, referrer_id, now):
                         logger.info("✅ Referral tracked: %s referred by %s", user_id, referrer_id)
+                        await referral_graph.record(user_id, referrer_id, now)
                         
                         # Notify referrer about their reward
-                        try:
-                            await context.bot.send_message(
-                                chat_id=referrer_id,
-                                text="🎁 *Congratulations!*\n\n"
-                                     "Someone used your invite link!\n\n"
-                                     "✅ You earned 1 Energy Refill Boost!\n\n"
-                                     "Use /boosts to see your rewards or click ⚡ REFILL in the game!",
-                                parse_mode='Markdown'
-                            )
-                        except Exception as e:
-                            logger.error("Could not notify referrer: %s", e)
-                    
-                    c.close()
-                    conn.close()
+                        send_queue.send(
+                            referrer_id,
+                            "🎁 *Congratulations!*\n\n"
+                            "Someone used your invite link!\n\n"
+                            "✅ You earned 1 Energy Refill Boost!\n\n"
+                            "Use /boosts to see your rewards or click ⚡ REFILL in the game!",
+                            parse_mode='Markdown'
+                        )
             except Exception as e:
                 logger.error("Referral error: %s", e)
     
     try:
-        keyboard = [[KeyboardButton(text="🕹️ PLAY BERT", web_app=WebAppInfo(url=GITHUB_URL))]]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+        state = await player_states.get(user_id)
+    except Exception as e:
+        logger.error("Player state error: %s", e)
+        state = None
+    
+    try:
+        reply_markup = play_keyboard(state)
         
-        await update.message.reply_text(
+        reply(update,
             "🎮 *Bert Tap Attack* 🎮\n\n"
             "✅ *HOW TO PLAY:*\n"
             "Use the *☰ Menu button* (bottom-left) → Play Game\n\n"
             "*Commands:*\n"
             "/leaderboard - View top players\n"
+            "/rank - See your position\n"
             "/invite - Get your referral link\n"
+            "/inviters - Top inviters\n"
             "/boosts - Check your energy boosts",
             parse_mode='Markdown',
             reply_markup=reply_markup
@@ -197,53 +2475,136 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.error("❌ Start error: %s", e)
 
+def leaderboard_keyboard(page, first, last, has_prev, has_next):
+    """Prev/next buttons carrying the keyset cursor of the page edges"""
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton(
+            "⬅️ Prev", callback_data=f"lb:p:{page - 1}:{first[0]}:{first[1]}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton(
+            "Next ➡️", callback_data=f"lb:n:{page + 1}:{last[0]}:{last[1]}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+def first_page_keyboard():
+    order = leaderboard_cache.order
+    has_next = len(order) > LEADERBOARD_SIZE or not leaderboard_cache.complete
+    if not order[:LEADERBOARD_SIZE] or not has_next:
+        return None
+    score, uid = order[LEADERBOARD_SIZE - 1]
+    return leaderboard_keyboard(1, None, (-score, -uid), False, True)
+
+@instrumented("leaderboard")
 async def leaderboard_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info("📊 /leaderboard from user %s", update.effective_user.id)
-    await update.message.reply_text(get_rank())
+    log_sampled("📊 /leaderboard from user %s", update.effective_user.id)
+    text = await get_rank()
+    reply(update, text, reply_markup=first_page_keyboard())
 
+@instrumented("leaderboard_page")
+async def leaderboard_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Prev/next buttons under /leaderboard (keyset pagination)"""
+    query = update.callback_query
+    await query.answer()
+    
+    try:
+        _, direction, page, score, uid = query.data.split(":")
+        page = int(page)
+        
+        if page <= 1:
+            await query.edit_message_text(await get_rank(), reply_markup=first_page_keyboard())
+            return
+        
+        rows, has_more = await get_leaderboard_page((int(score), int(uid)), forward=(direction == "n"))
+        if not rows:
+            await query.edit_message_text(await get_rank(), reply_markup=first_page_keyboard())
+            return
+        
+        msg = f"🏆 Global Leaderboard - Page {page} 🏆\n\n"
+        offset = (page - 1) * LEADERBOARD_SIZE
+        for i, (_, name, row_score) in enumerate(rows):
+            msg += f"{offset + i + 1}. {name}: {row_score:,}\n"
+        
+        has_next = has_more if direction == "n" else True
+        first = (rows[0][2], rows[0][0])
+        last = (rows[-1][2], rows[-1][0])
+        await query.edit_message_text(
+            msg, reply_markup=leaderboard_keyboard(page, first, last, True, has_next))
+    except Exception as e:
+        logger.error("Leaderboard page error: %s", e)
+
+@instrumented("rank")
+async def rank_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    log_sampled("📍 /rank from user %s", update.effective_user.id)
+    user_id = update.effective_user.id
+    
+    try:
+        result = await get_player_rank(user_id)
+        if result is None:
+            reply(update, "🏆 You're not on the leaderboard yet!\n\nPlay and SYNC your score first.")
+            return
+        
+        name, score, position, total, above, below = result
+        msg = f"📍 Your Rank: #{position:,} of {total:,}\n\n"
+        for n, s in reversed(above):
+            msg += f"⬆️ {n}: {s:,}\n"
+        msg += f"➡️ {name}: {score:,} (you)\n"
+        for n, s in below:
+            msg += f"⬇️ {n}: {s:,}\n"
+        reply(update, msg)
+    except Exception as e:
+        logger.error("Rank error: %s", e)
+        reply(update, "❌ Error loading your rank")
+
+@instrumented("invite")
 async def invite_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info("🎁 /invite from user %s", update.effective_user.id)
+    log_sampled("🎁 /invite from user %s", update.effective_user.id)
     user_id = update.effective_user.id
     bot_username = "berttapbot"
     invite_link = f"https://t.me/{bot_username}?start=ref_{user_id}"
     
     try:
-        conn = psycopg.connect(DATABASE_URL)
-        c = conn.cursor()
-        c.execute("SELECT total_referrals FROM referrals WHERE user_id = %s", (user_id,))
-        result = c.fetchone()
-        total_refs = result[0] if result else 0
-        c.close()
-        conn.close()
-        
-        await update.message.reply_text(
+        if not referral_graph.loaded:
+            await referral_graph.load()
+        total_refs = referral_graph.referrals(user_id)
+        team, levels = referral_graph.tree(user_id)
+        
+        reply(update,
             f"🎁 *Invite Friends & Earn Rewards!*\n\n"
             f"Share your link:\n`{invite_link}`\n\n"
             f"🎯 *Rewards per friend:*\n"
             f"• 60-minute Energy Refill Boost\n\n"
             f"👥 *Your Stats:*\n"
-            f"Friends invited: {total_refs}\n\n"
+            f"Friends invited: {total_refs}\n"
+            f"Your network: {team} player(s), {levels} level(s) deep\n\n"
             f"💡 Tap the link above to copy it!",
             parse_mode='Markdown'
         )
     except Exception as e:
         logger.error("Invite error: %s", e)
 
+@instrumented("inviters")
+async def inviters_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    log_sampled("🎁 /inviters from user %s", update.effective_user.id)
+    
+    try:
+        if not referral_graph.loaded:
+            await referral_graph.load()
+        reply(update, await referral_graph.render())
+    except Exception as e:
+        logger.error("Inviters error: %s", e)
+        reply(update, "❌ Error loading top inviters")
+
+@instrumented("boosts")
 async def boosts_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info("⚡ /boosts from user %s", update.effective_user.id)
+    log_sampled("⚡ /boosts from user %s", update.effective_user.id)
     user_id = update.effective_user.id
     
     try:
-        conn = psycopg.connect(DATABASE_URL)
-        c = conn.cursor()
-        c.execute("SELECT energy_boosts, total_referrals FROM referrals WHERE user_id = %s", (user_id,))
-        result = c.fetchone()
+        result = await db_fetchone("SELECT energy_boosts, total_referrals FROM referrals WHERE user_id = %s", (user_id,))
         boosts = result[0] if result else 0
         total_refs = result[1] if result else 0
-        c.close()
-        conn.close()
         
-        await update.message.reply_text(
+        reply(update,
             f"⚡ *Your Energy Boosts*\n\n"
             f"Available: *{boosts}* boost(s)\n"
             f"Total referrals: {total_refs}\n\n"
@@ -255,25 +2616,26 @@ async def boosts_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.error("Boosts error: %s", e)
 
+@instrumented("cheaters")
 async def cheaters_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin command to view cheater statistics"""
     logger.info("🚨 /cheaters from user %s", update.effective_user.id)
     
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        reply(update, "❌ Unauthorized. Admin only.")
+        return
+    
     try:
-        conn = psycopg.connect(DATABASE_URL)
-        c = conn.cursor()
-        c.execute("""
+        await cheater_queue.flush()
+        res = await db_fetchall("""
             SELECT user_id, username, first_flagged, flag_count, last_flag_reason, suspicious_count 
             FROM cheaters 
             ORDER BY first_flagged DESC 
             LIMIT 20
         """)
-        res = c.fetchall()
-        c.close()
-        conn.close()
         
         if not res:
-            await update.message.reply_text("✅ No cheaters detected yet!")
+            reply(update, "✅ No cheaters detected yet!")
         else:
             msg = f"🚨 *Cheater Log* ({len(res)} total)\n\n"
             for row in res:
@@ -285,132 +2647,396 @@ async def cheaters_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 
                 # Split message if too long
                 if len(msg) > 3500:
-                    await update.message.reply_text(msg, parse_mode='Markdown')
+                    reply(update, msg, parse_mode='Markdown')
                     msg = ""
             
             if msg:
-                await update.message.reply_text(msg, parse_mode='Markdown')
+                reply(update, msg, parse_mode='Markdown')
     except Exception as e:
         logger.error("Cheaters command error: %s", e)
-        await update.message.reply_text(f"❌ Error: {e}")
+        reply(update, f"❌ Error: {e}")
 
+@instrumented("farms")
+async def farms_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command listing suspected referral farms"""
+    logger.info("🕸️ /farms from user %s", update.effective_user.id)
+    
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        reply(update, "❌ Unauthorized. Admin only.")
+        return
+    
+    try:
+        if not referral_graph.loaded:
+            await referral_graph.load()
+        farms = referral_graph.farms()
+        if not farms:
+            reply(update, "✅ No referral farms detected!")
+            return
+        
+        msg = (f"🕸️ Suspected referral farms ({len(farms)})\n"
+               f"{REFERRAL_FARM_MIN_FRESH}+ referrals in {REFERRAL_FARM_WINDOW / 3600:g}h, "
+               f"{REFERRAL_FARM_IDLE_RATIO:.0%}+ without a score\n\n")
+        for referrer, fresh, idle in farms[:20]:
+            team, levels = referral_graph.tree(referrer)
+            msg += (f"ID {referrer}: {idle:,}/{fresh:,} fresh idle, "
+                    f"{referral_graph.referrals(referrer):,} total, network {team:,} ({levels} deep)\n")
+        reply(update, msg)
+    except Exception as e:
+        logger.error("Farms command error: %s", e)
+        reply(update, f"❌ Error: {e}")
+
+@instrumented("reset_all")
 async def reset_all_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin command to reset all scores to zero"""
     logger.info("🔄 /reset_all from user %s", update.effective_user.id)
     
-    # SECURITY: Add your Telegram user ID here
-    ADMIN_USER_IDS = [7137489161]  # Replace with your actual user ID
-    
     if update.effective_user.id not in ADMIN_USER_IDS:
-        await update.message.reply_text("❌ Unauthorized. Admin only.")
+        reply(update, "❌ Unauthorized. Admin only.")
         logger.warning("⚠️ Unauthorized reset attempt by user %s", update.effective_user.id)
         return
     
     try:
-        conn = psycopg.connect(DATABASE_URL)
-        c = conn.cursor()
-        
-        # Count before reset
-        c.execute("SELECT COUNT(*) FROM leaderboard")
-        count = c.fetchone()[0]
+        # Land everything synced so far in the old season, then switch
+        await score_buffer.flush()
+        season, count = await start_new_season()
+        leaderboard_cache.clear()
+        spawn(run_archive())
         
-        # Reset all scores to zero
-        c.execute("UPDATE leaderboard SET score = 0")
-        conn.commit()
-        
-        c.close()
-        conn.close()
-        
-        logger.info("✅ All scores reset by admin %s", update.effective_user.id)
-        await update.message.reply_text(
+        logger.info("✅ All scores reset by admin %s (season %s)", update.effective_user.id, season)
+        reply(update,
             f"✅ *All Scores Reset*\n\n"
             f"Reset {count} player(s) to 0 points.\n\n"
-            f"Leaderboard has been cleared!",
+            f"Leaderboard has been cleared! Season {season} has started.",
             parse_mode='Markdown'
         )
     except Exception as e:
         logger.error("Reset error: %s", e)
-        await update.message.reply_text(f"❌ Error: {e}")
+        reply(update, f"❌ Error: {e}")
+
+ARCHIVE_LOCK = 0x62657274  # advisory lock key: one archiver across all workers
 
+async def run_archive():
+    try:
+        async with db_pool.connection() as conn:
+            await conn.set_autocommit(True)
+            try:
+                cur = await conn.execute("SELECT pg_try_advisory_lock(%s)", (ARCHIVE_LOCK,))
+                if not (await cur.fetchone())[0]:
+                    logger.info("📦 Another worker is archiving")
+                    return
+                try:
+                    await archive_seasons()
+                finally:
+                    await conn.execute("SELECT pg_advisory_unlock(%s)", (ARCHIVE_LOCK,))
+            finally:
+                if not conn.broken:
+                    await conn.set_autocommit(False)
+    except Exception as e:
+        logger.error("❌ Season archive error: %s", e)
+
+@instrumented("stats")
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command to view throttling counters"""
+    logger.info("📈 /stats from user %s", update.effective_user.id)
+    
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        reply(update, "❌ Unauthorized. Admin only.")
+        return
+    
+    msg = "📈 Throttling\n\n"
+    for action, (rate, burst) in THROTTLE_LIMITS.items():
+        msg += (f"{action}: {throttle.shed[action]:,} shed "
+                f"({throttle.warned[action]:,} warned) - limit {rate:g}/s, burst {burst:g}\n")
+    msg += f"\nScore-rate rejections: {session_tracker.rejected:,}"
+    msg += "\nTap batch flags: " + ", ".join(f"{layer} {tap_flags[layer]:,}" for layer in TapReport._fields[1:])
+    msg += f"\nCheater flags dropped (queue full): {cheater_queue.dropped:,}"
+    msg += (f"\nRepeats dropped: {update_dedup.duplicates:,} redelivered updates, "
+            f"{update_dedup.repeated_boosts:,} use_boost keys")
+    if referral_graph.loaded:
+        msg += f"\nSuspected referral farms: {len(referral_graph.farms()):,} (/farms)"
+    msg += f"\n\n⏱️ Startup: {startup.summary()}"
+    msg += (f"\n\n📤 Messages: {send_queue.outcomes['sent']:,} sent, "
+            f"{send_queue.outcomes['blocked']:,} blocked, {send_queue.outcomes['failed']:,} failed, "
+            f"{send_queue.outcomes['dropped']:,} dropped, {send_queue.retried:,} retried, {send_queue.pending():,} queued")
+    reply(update, msg)
+
+broadcast_task = None
+
+async def broadcast_recipients():
+    """Every known player id (leaderboard or referrals), in ascending keyset pages"""
+    last = 0
+    while True:
+        rows = await db_fetchall("""
+            SELECT id FROM (
+                (SELECT user_id AS id FROM referrals WHERE user_id > %(last)s ORDER BY user_id LIMIT %(n)s)
+                UNION
+                (SELECT id FROM leaderboard WHERE id > %(last)s ORDER BY id LIMIT %(n)s)
+            ) players
+            ORDER BY id LIMIT %(n)s
+        """, {'last': last, 'n': BROADCAST_BATCH_SIZE})
+        for (uid,) in rows:
+            yield uid
+        if len(rows) < BROADCAST_BATCH_SIZE:
+            return
+        last = rows[-1][0]
+
+async def run_broadcast(admin_chat_id, text):
+    """Queue `text` for every player, then report the outcome to the admin"""
+    global broadcast_task
+    broadcast = Broadcast()
+    started = time.monotonic()
+    status = "finished"
+    try:
+        async for uid in broadcast_recipients():
+            await send_queue.send_bulk(uid, text, broadcast)
+        broadcast.close()
+        await broadcast.finished.wait()
+    except asyncio.CancelledError:
+        status = "cancelled"
+        send_queue.cancel_bulk()
+    except Exception as e:
+        status = "aborted"
+        logger.error("❌ Broadcast error: %s", e)
+    finally:
+        broadcast_task = None
+    
+    outcomes = broadcast.outcomes
+    logger.info("📣 Broadcast %s: %s", status, dict(outcomes))
+    send_queue.send(
+        admin_chat_id,
+        f"📣 Broadcast {status} in {time.monotonic() - started:.0f}s\n\n"
+        f"Sent: {outcomes['sent']:,}\n"
+        f"Blocked the bot: {outcomes['blocked']:,}\n"
+        f"Failed: {outcomes['failed']:,}\n"
+        f"Not sent: {broadcast.queued - outcomes['sent'] - outcomes['blocked'] - outcomes['failed']:,}"
+    )
+
+@instrumented("broadcast")
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command: `/broadcast <message>` to every player, `/broadcast cancel` to stop"""
+    global broadcast_task
+    logger.info("📣 /broadcast from user %s", update.effective_user.id)
+    
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        reply(update, "❌ Unauthorized. Admin only.")
+        return
+    
+    parts = update.message.text.split(None, 1)
+    text = parts[1].strip() if len(parts) > 1 else ""
+    if not text:
+        reply(update, "Usage: /broadcast <message>\n/broadcast cancel - stop a running broadcast")
+        return
+    
+    if text.lower() == "cancel":
+        if broadcast_task is None:
+            reply(update, "No broadcast is running.")
+        else:
+            broadcast_task.cancel()
+        return
+    
+    if broadcast_task is not None:
+        reply(update, "⏳ A broadcast is already running. Use /broadcast cancel to stop it.")
+        return
+    
+    broadcast_task = spawn(run_broadcast(update.effective_chat.id, text))
+    reply(update, f"📣 Broadcast started (up to {SEND_RATE:g} messages/s). You'll get a summary when it's done.")
+
+async def export_leaderboard(fileobj, compress=False):
+    """Stream the current season's leaderboard as CSV into a binary file.
+
+    Rows come through a named server-side cursor EXPORT_CHUNK_SIZE at a
+    time and are written (and optionally gzipped) as they arrive, so memory
+    stays flat however large the table is. Returns the number of rows.
+    """
+    raw = gzip.GzipFile(fileobj=fileobj, mode='wb') if compress else fileobj
+    out = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+    writer = csv.writer(out)
+    writer.writerow(["rank", "id", "name", "score"])
+    count = 0
+    
+    def write_chunk(rows, start):
+        writer.writerows((start + i, uid, name, score) for i, (uid, name, score) in enumerate(rows, 1))
+    
+    async with db_pool.connection() as conn:
+        cur = conn.cursor(name="leaderboard_export")
+        try:
+            await cur.execute("""
+                SELECT id, name, score FROM leaderboard
+                WHERE season = %s
+                ORDER BY score DESC, id DESC
+            """, (current_season,))
+            while True:
+                rows = await cur.fetchmany(EXPORT_CHUNK_SIZE)
+                if not rows:
+                    break
+                await asyncio.to_thread(write_chunk, rows, count)
+                count += len(rows)
+        finally:
+            await cur.close()
+    
+    out.flush()
+    out.detach()
+    if compress:
+        raw.close()
+    return count
+
+def copy_part(src, dst, length):
+    """Copy up to `length` bytes from `src`'s position into `dst`"""
+    while length > 0:
+        chunk = src.read(min(length, 1 << 20))
+        if not chunk:
+            break
+        dst.write(chunk)
+        length -= len(chunk)
+
+async def send_export(update, f, filename, caption):
+    """Send the export in `f` (positioned at its end) as a document.
+
+    The upload streams from disk (read_file_handle=False) rather than being
+    read into memory. Past EXPORT_PART_SIZE the file is cut into numbered
+    parts, each copied to its own temporary file and sent in turn; `cat`
+    joins them back.
+    """
+    size = f.tell()
+    if size <= EXPORT_PART_SIZE:
+        await update.message.reply_document(
+            document=InputFile(f, filename=filename, read_file_handle=False),
+            caption=caption, write_timeout=EXPORT_WRITE_TIMEOUT)
+        return
+    parts = -(-size // EXPORT_PART_SIZE)
+    f.seek(0)
+    for n in range(1, parts + 1):
+        with tempfile.TemporaryFile() as part:
+            await asyncio.to_thread(copy_part, f, part, EXPORT_PART_SIZE)
+            note = f"{caption}, part {n}/{parts}"
+            if n == parts:
+                note += f"\nJoin with: cat {filename}.* > {filename}"
+            await update.message.reply_document(
+                document=InputFile(part, filename=f"{filename}.{n:03d}", read_file_handle=False),
+                caption=note, write_timeout=EXPORT_WRITE_TIMEOUT)
+
+@instrumented("debug")
 async def debug_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show the first DEBUG_TEXT_ROWS rows; `/debug export [gz]` sends the whole table as CSV"""
     logger.info("🔧 /debug from user %s", update.effective_user.id)
     try:
-        conn = psycopg.connect(DATABASE_URL)
-        c = conn.cursor()
-        c.execute("SELECT id, name, score FROM leaderboard ORDER BY score DESC")
-        res = c.fetchall()
-        c.close()
-        conn.close()
+        if context.args and context.args[0] == "export":
+            if update.effective_user.id not in ADMIN_USER_IDS:
+                reply(update, "❌ Unauthorized. Admin only.")
+                return
+            compress = len(context.args) > 1 and context.args[1] == "gz"
+            filename = f"leaderboard_season{current_season}.csv" + (".gz" if compress else "")
+            with tempfile.TemporaryFile() as f:
+                count = await export_leaderboard(f, compress)
+                await send_export(update, f, filename, f"📊 {count:,} entries (season {current_season})")
+            logger.info("Exported %s entries", count)
+            return
+        
+        res = await db_fetchall("""
+            SELECT id, name, score FROM leaderboard WHERE season = %s
+            ORDER BY score DESC, id DESC LIMIT %s
+        """, (current_season, DEBUG_TEXT_ROWS))
         
         if not res:
-            await update.message.reply_text("❌ Database is empty!")
+            reply(update, "❌ Database is empty!")
         else:
-            msg = f"📊 Database Contents ({len(res)} entries):\n\n"
+            msg = f"📊 Database Contents (top {len(res)} entries):\n\n"
             for row in res:
                 msg += f"ID: {row[0]}\nName: {row[1]}\nScore: {row[2]:,}\n\n"
-            await update.message.reply_text(msg)
+                
+                # Split message if too long
+                if len(msg) > 3500:
+                    reply(update, msg)
+                    msg = ""
+            if len(res) == DEBUG_TEXT_ROWS:
+                msg += "💾 Use /debug export (or /debug export gz) for the full table."
+            if msg:
+                reply(update, msg)
             logger.info("Database has %s entries", len(res))
     except Exception as e:
         logger.error("Debug error: %s", e)
-        await update.message.reply_text(f"❌ Error: {e}")
+        reply(update, f"❌ Error: {e}")
+
+async def throttled(update: Update, action):
+    """True if this web_app_data request is over its rate limit (and has been handled)"""
+    if MULTI_WORKER:
+        verdict = await throttle.allow_shared(update.effective_user.id, action)
+    else:
+        verdict = throttle.allow(update.effective_user.id, action)
+    if verdict == Throttle.ALLOW:
+        return False
+    if verdict == Throttle.WARN:
+        logger.warning("⏳ Throttled %s from user %s", action, update.effective_user.id)
+        reply(update, "⏳ Slow down! Please wait a few seconds and try again.")
+    return True
 
+@instrumented("webapp_data")
 async def handle_webapp_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info("=" * 60)
-    logger.info("🎯 WEBAPP DATA RECEIVED!")
-    logger.info("User: %s (%s)", update.effective_user.first_name, update.effective_user.id)
+    raw = update.effective_message.web_app_data.data
+    action = webapp_action(raw)
+    if await throttled(update, action):
+        return
+    
+    log_sampled("🎯 WEBAPP DATA from %s (%s): %s", update.effective_user.first_name,
+              update.effective_user.id, action)
     
     try:
-        data = json.loads(update.effective_message.web_app_data.data)
-        action = data.get('action', 'sync')
+        data = json.loads(raw)
+        parsed_action = data.get('action', 'sync')
+        if not isinstance(parsed_action, str) or parsed_action not in THROTTLE_LIMITS:
+            parsed_action = 'sync'  # anything else is handled as a sync below
+        if parsed_action != action:
+            # Payload mentioned another action's name; charge the real bucket too
+            action = parsed_action
+            if await throttled(update, action):
+                return
         
         if action == 'get_boosts':
             # Send energy boosts to game
             user_id = update.effective_user.id
-            conn = psycopg.connect(DATABASE_URL)
-            c = conn.cursor()
-            c.execute("SELECT energy_boosts FROM referrals WHERE user_id = %s", (user_id,))
-            result = c.fetchone()
-            boosts = result[0] if result else 0
-            c.close()
-            conn.close()
+            boosts = await get_boosts(user_id)
             
-            await update.message.reply_text(f"⚡ You have {boosts} energy boost(s)!")
-            logger.info("Sent boost count: %s", boosts)
+            reply(update, f"⚡ You have {boosts} energy boost(s)!")
+            log_sampled("Sent boost count: %s", boosts)
             return
         
         elif action == 'use_boost':
-            # Use an energy boost
+            # Use an energy boost; a `key` makes a retried request spend at most once
             user_id = update.effective_user.id
-            conn = psycopg.connect(DATABASE_URL)
-            c = conn.cursor()
-            c.execute("SELECT energy_boosts FROM referrals WHERE user_id = %s", (user_id,))
-            result = c.fetchone()
-            boosts = result[0] if result else 0
+            key = data.get('key')
+            if key is None:
+                remaining = await spend_boost(user_id)
+            elif not isinstance(key, str) or not 0 < len(key) <= BOOST_KEY_MAX_LENGTH:
+                reply(update, "⚠️ Invalid request!")
+                return
+            else:
+                claimed, remaining = await spend_boost_once(user_id, key)
+                if not claimed:
+                    update_dedup.repeated_boosts += 1
+                    log_sampled("♻️ Repeated use_boost key from %s ignored", user_id)
+                    return
             
-            if boosts > 0:
-                c.execute("""
-                    UPDATE referrals 
-                    SET energy_boosts = energy_boosts - 1 
-                    WHERE user_id = %s
-                """, (user_id,))
-                conn.commit()
-                new_count = boosts - 1
-                await update.message.reply_text(
+            if remaining is not None:
+                # Without a row the game keeps its own state (it refilled already)
+                state = await player_states.get(user_id)
+                if state is not None:
+                    state.refill()
+                    await player_states.save(user_id, state)
+                reply(update,
                     f"✅ *Energy Refilled!*\n\n"
-                    f"Boosts remaining: {new_count}",
-                    parse_mode='Markdown'
+                    f"Boosts remaining: {remaining}",
+                    parse_mode='Markdown',
+                    reply_markup=play_keyboard(state)
                 )
-                logger.info("Boost used by %s, remaining: %s", user_id, new_count)
+                log_sampled("Boost used by %s, remaining: %s", user_id, remaining)
             else:
                 # Send message that will trigger invite prompt
-                await update.message.reply_text(
+                reply(update,
                     "❌ *No boosts available!*\n\n"
                     "💡 Click OK to share your invite link and earn more boosts!",
                     parse_mode='Markdown'
                 )
             
-            c.close()
-            conn.close()
             return
         
         # Default: sync score
@@ -418,8 +3044,6 @@ async def handle_webapp_data(update: Update, context: ContextTypes.DEFAULT_TYPE)
         flagged = data.get('flagged', False)
         suspicious_count = data.get('suspiciousCount', 0)
         
-        logger.info("📊 Score: %s", score)
-        
         # === SERVER-SIDE ANTI-CHEAT ===
         
         # Check 1: Client flagged for cheating
@@ -436,7 +3060,7 @@ async def handle_webapp_data(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 suspicious_count
             )
             
-            await update.message.reply_text(
+            reply(update,
                 "🚫 *ANTI-CHEAT DETECTION*\n\n"
                 "Your account was flagged for suspicious activity.\n\n"
                 "Detected: Auto-tapper or bot pattern\n\n"
@@ -445,6 +3069,39 @@ async def handle_webapp_data(update: Update, context: ContextTypes.DEFAULT_TYPE)
             )
             return
         
+        # Check 1b: Rerun the client-side checks on the taps sent with the sync
+        # (a sync without any may not add coins, see Check 5)
+        taps = data.get('taps')
+        tapped = False
+        if taps is not None:
+            try:
+                report = analyze_taps(*decode_taps(taps))
+            except (TypeError, ValueError) as e:
+                logger.warning("⚠️ Invalid tap batch from user %s: %s", update.effective_user.id, e)
+                reply(update, "⚠️ Invalid tap data!")
+                return
+            tapped = report.taps > 0
+            failed = tap_violations(report)
+            if failed:
+                logger.warning("🚫 CHEATER FLAGGED BY SERVER! User %s (ID: %s): %s", 
+                             update.effective_user.first_name, update.effective_user.id, report)
+                for layer in failed:
+                    tap_flags[layer] += 1
+                log_cheater(
+                    update.effective_user.id,
+                    update.effective_user.first_name,
+                    f"Server-side anti-cheat: {', '.join(failed)} checks failed over {report.taps} taps",
+                    sum(getattr(report, layer) for layer in failed)
+                )
+                reply(update,
+                    "🚫 *ANTI-CHEAT DETECTION*\n\n"
+                    "Your account was flagged for suspicious activity.\n\n"
+                    "Detected: Auto-tapper or bot pattern\n\n"
+                    "Your score has been rejected.",
+                    parse_mode='Markdown'
+                )
+                return
+        
         # Check 2: Log suspicious but not flagged users
         if suspicious_count > 0:
             logger.warning("⚠️ User %s has suspicious count: %s (not flagged yet)", 
@@ -454,39 +3111,383 @@ async def handle_webapp_data(update: Update, context: ContextTypes.DEFAULT_TYPE)
         if not isinstance(score, int) or score < 0:
             logger.warning("⚠️ Invalid score type from user %s: %s", 
                          update.effective_user.id, score)
-            await update.message.reply_text("⚠️ Invalid score!")
+            reply(update, "⚠️ Invalid score!")
             return
         
         # Check 4: Maximum score validation
-        if score > 10000000:
+        if score > MAX_SCORE:
             logger.warning("🚫 SUSPICIOUS SCORE! User %s tried to submit %s", 
                          update.effective_user.id, score)
-            await update.message.reply_text("⚠️ Score too high! Maximum 10,000,000 allowed.")
+            reply(update, "⚠️ Score too high! Maximum 10,000,000 allowed.")
             return
         
-        # Check 5: Impossible score rate check (optional - based on session time)
-        # TODO: Track session start time and validate score/time ratio
+        # Check 4b: Boosts and cards bought since the last sync must be allowed
+        state = await player_states.get(update.effective_user.id)
+        buys = data.get('buys', [])
+        seeded = state is None
+        if seeded:
+            # First sync with a server-side economy: start from what the game
+            # reports owning, which must have been affordable (see below)
+            if 'levels' not in data:
+                reply(update, "⚠️ Please reopen the game and sync again.")
+                return
+            seed = PlayerState.seed(data.get('levels'), data.get('cards'), buys, time.time())
+            if seed is None:
+                logger.warning("🚫 INVALID HOLDINGS! User %s: levels %s, cards %s, buys %s",
+                               update.effective_user.id, data.get('levels'), data.get('cards'), buys)
+                reply(update, "⚠️ Invalid purchase! Score rejected.")
+                return
+            state, owned = seed
+        spent = state.apply(buys)
+        if spent is None:
+            logger.warning("🚫 INVALID PURCHASE! User %s: %s", update.effective_user.id, buys)
+            reply(update, "⚠️ Invalid purchase! Score rejected.")
+            return
+        if seeded:
+            # Every coin held or spent was earned by a tap worth at most MAX_TAP_POWER
+            total_taps = data.get('totalTaps')
+            if type(total_taps) is not int or score + owned + spent > total_taps * MAX_TAP_POWER:
+                logger.warning("🚫 UNAFFORDABLE HOLDINGS! User %s: %s coins owned, %s spent, %s held, %s taps",
+                               update.effective_user.id, owned, spent, score, total_taps)
+                reply(update, "⚠️ Invalid purchase! Score rejected.")
+                return
+        
+        # Check 5: Impossible score rate check (based on last accepted sync)
+        # Coins spent on purchases had to be earned too, and only by tapping
+        if not await session_tracker.accept(update.effective_user.id, score, spent, tapped):
+            if not tapped:
+                logger.warning("🚫 COINS WITHOUT TAPS! User %s tried to submit %s (spent %s)",
+                             update.effective_user.id, score, spent)
+                reply(update, "⚠️ Score rejected! No taps were sent with it.")
+                return
+            logger.warning("🚫 IMPOSSIBLE SCORE RATE! User %s tried to submit %s (spent %s)", 
+                         update.effective_user.id, score, spent)
+            reply(update, "⚠️ Score rejected! You can't earn coins that fast.")
+            return
         
         # Score passed all checks - save to database
         
-        update_db(update.effective_user.id, update.effective_user.first_name, score)
-        await update.message.reply_text("✅ Score Synced!\n\n" + get_rank())
-        logger.info("✅ SUCCESS!")
+        score_buffer.add(update.effective_user.id, update.effective_user.first_name, score)
+        leaderboard_cache.update(update.effective_user.id, str(update.effective_user.first_name), score)
+        if score > 0:
+            referral_graph.mark_active(update.effective_user.id)
+        if seeded or buys or 'energy' in data:
+            state.use_energy(data.get('energy'))
+            await player_states.save(update.effective_user.id, state)
+        log_sampled("✅ Score queued: User %s = %s", update.effective_user.id, score)
+        reply(update, "✅ Score Synced!\n\n" + await get_rank(), reply_markup=play_keyboard(state))
         
     except Exception as e:
         logger.error("❌ Error: %s", e)
-        await update.message.reply_text("❌ Sync failed")
-    
-    logger.info("=" * 60)
+        reply(update, "❌ Sync failed")
+
+class UpdateDedup(BackgroundFlusher):
+    """Recently processed update_ids, so an update Telegram redelivers runs once.
+
+    Ids are kept for `ttl` seconds in an OrderedDict (oldest first, at most
+    `max_size`), so a redelivery to the same worker is caught without a
+    query. With `shared`, a new id is also claimed in `processed_updates`
+    with one insert, catching redeliveries that reach another worker or
+    arrive after a restart. flush() expires old rows there and in
+    `boost_spends` (the use_boost idempotency keys).
+    """
+
+    name = "Update dedup"
+
+    CLAIM = """
+        INSERT INTO processed_updates (update_id, seen_at) VALUES (%s, %s)
+        ON CONFLICT DO NOTHING
+        RETURNING 1
+    """
+
+    def __init__(self, ttl, max_size, interval, shared=False):
+        super().__init__(interval)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.shared = shared
+        self.seen = OrderedDict()  # update_id -> first seen
+        self.duplicates = 0
+        self.repeated_boosts = 0
+
+    def first_time(self, update_id, now=None):
+        """True, and remembered, unless `update_id` was seen within the TTL"""
+        now = time.time() if now is None else now
+        seen = self.seen
+        if update_id in seen:
+            self.duplicates += 1
+            return False
+        seen[update_id] = now
+        while seen and (len(seen) > self.max_size or now - next(iter(seen.values())) > self.ttl):
+            seen.popitem(last=False)
+        return True
+
+    async def claim(self, update_id):
+        """first_time() on this worker and, when shared, in Postgres"""
+        now = time.time()
+        if not self.first_time(update_id, now):
+            return False
+        if self.shared and await db_fetchone_atomic(self.CLAIM, (update_id, now)) is None:
+            self.duplicates += 1
+            return False
+        return True
+
+    def clear(self):
+        self.seen.clear()
+
+    async def flush(self):
+        now = time.time()
+        await db_execute("DELETE FROM boost_spends WHERE spent_at < %s", (now - BOOST_KEY_TTL,))
+        if self.shared:
+            await db_execute("DELETE FROM processed_updates WHERE seen_at < %s", (now - self.ttl,))
+
+update_dedup = UpdateDedup(UPDATE_DEDUP_TTL, UPDATE_DEDUP_MAX, SESSION_FLUSH_INTERVAL * 2, shared=UPDATE_DEDUP_DB)
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Runs up to `max_concurrent_updates` updates at once, in order per user.
+
+    Each user's (or, without a user, each chat's) updates form a chain:
+    an update waits for the previous one from the same sender to finish
+    before it takes a concurrency slot, so a queued use_boost can never
+    overtake a sync, and a player flooding the bot holds at most one slot.
+    At the head of its chain, an update Telegram has already delivered is
+    dropped (see UpdateDedup).
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._tails = {}  # sender -> future resolved when their latest update is done
+
+    @staticmethod
+    def sender(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    @staticmethod
+    async def claim(update):
+        """False if `update` was delivered before (see UpdateDedup)"""
+        if not isinstance(update, Update):
+            return True
+        try:
+            first = await update_dedup.claim(update.update_id)
+        except Exception as e:
+            logger.error("❌ Update dedup error: %s", e)
+            first = True
+        if not first:
+            log_sampled("♻️ Redelivered update %s dropped", update.update_id)
+            return False
+        startup.mark('update')
+        return True
+
+    async def process_update(self, update, coroutine):
+        key = self.sender(update)
+        if key is None:
+            if await self.claim(update):
+                await super().process_update(update, coroutine)
+            else:
+                coroutine.close()
+            return
+        # Join the sender's chain before anything is awaited: the claim is a
+        # database round trip when shared, and a later update from the same
+        # sender must not get ahead of this one during it
+        previous = self._tails.get(key)
+        done = asyncio.get_running_loop().create_future()
+        self._tails[key] = done
+        try:
+            if previous is not None:
+                try:
+                    await asyncio.shield(previous)
+                except asyncio.CancelledError:
+                    coroutine.close()
+                    raise
+            if not await self.claim(update):
+                coroutine.close()
+                return
+            await super().process_update(update, coroutine)
+        finally:
+            done.set_result(None)
+            if self._tails.get(key) is done:
+                del self._tails[key]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+# === STARTUP ===
+# A sleeping instance is woken by the update it has to answer, so a cold
+# start is on a player's critical path. post_init() only opens the pool and
+# checks the schema; the caches load in warm_up() while Telegram registers
+# the webhook. Updates are served meanwhile: until its load finishes, each
+# cache looks players up one at a time.
+
+def process_age():
+    """Seconds since this process was started (Linux), or 0 if unknown"""
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return 0.0
+
+class StartupTimer:
+    """When each startup phase finished, in seconds since process launch.
+
+    The first getMe, setWebhook and sendMessage are noted by TimedRequest;
+    the time of the first sendMessage is the time to first reply.
+    """
+
+    PHASES = {
+        'imports': "modules imported",
+        'bot': "getMe",
+        'schema': "schema checked",
+        'webhook': "webhook set",
+        'warm': "caches warm",
+        'update': "first update",
+        'reply': "first reply",
+    }
+    METHODS = {'getMe': 'bot', 'setWebhook': 'webhook', 'sendMessage': 'reply'}
+
+    def __init__(self):
+        self.t0 = time.perf_counter() - process_age()
+        self.at = {'imports': time.perf_counter() - self.t0}
+        self.warm = asyncio.Event()
+
+    def mark(self, phase):
+        if phase in self.at:
+            return
+        self.at[phase] = time.perf_counter() - self.t0
+        if phase in ('reply', 'warm'):
+            logger.info("⏱️ %s %.2fs after launch: %s", self.PHASES[phase].capitalize(), self.at[phase],
+                        self.summary())
+
+    def observe(self, method):
+        """A Bot API call succeeded"""
+        phase = self.METHODS.get(method)
+        if phase is not None and phase not in self.at:
+            self.mark(phase)
+
+    def summary(self):
+        return ", ".join(f"{label} {self.at[phase]:.2f}s" for phase, label in self.PHASES.items()
+                         if phase in self.at)
+
+startup = StartupTimer()
+
+async def warm_up():
+    """Load the caches concurrently; `startup.warm` is set when they are done"""
+    async def load(what, cache):
+        try:
+            await cache.load()
+        except Exception as e:
+            logger.error("❌ %s load failed: %s", what, e)
+
+    try:
+        await asyncio.gather(
+            load("Session", session_tracker),
+            load("Player state", player_states),
+            load("Leaderboard cache", leaderboard_cache),
+        )
+        startup.mark('warm')
+    finally:
+        startup.warm.set()
+
+async def load_referral_graph():
+    """Load in the background; /invite and friends wait for it if they need it first"""
+    try:
+        await referral_graph.load()
+    except Exception as e:
+        logger.error("❌ Referral graph load failed: %s", e)
+
+async def post_init(app: Application):
+    """Open the shared pool inside the bot's event loop and check the schema.
+
+    Everything else loads in the background: the webhook is registered
+    as soon as this returns.
+    """
+    startup.warm.clear()
+    await db_pool.open(wait=True, timeout=DB_POOL_TIMEOUT)
+    logger.info("✅ DB pool open (min=%s, max=%s)", DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE)
+    await init_db()
+    startup.mark('schema')
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT)
+        logger.info("📈 Metrics on :%s/metrics", METRICS_PORT)
+    spawn(warm_up())
+    score_buffer.start()
+    session_tracker.start()
+    player_states.start()
+    cheater_queue.start()
+    worker_sync.start()
+    update_dedup.start()
+    spawn(load_referral_graph())
+    referral_graph.start()
+    send_queue.start(app.bot)
+    spawn(run_archive())
+
+async def post_stop(app: Application):
+    """Deliver queued messages while the bot can still send them"""
+    task = broadcast_task
+    if task is not None:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    await send_queue.stop(SEND_DRAIN_TIMEOUT)
+
+async def post_shutdown(app: Application):
+    for flusher in (worker_sync, score_buffer, session_tracker, player_states, cheater_queue, referral_graph,
+                    update_dedup):
+        try:
+            await flusher.stop()
+        except Exception as e:
+            logger.error("❌ Final %s flush failed: %s", flusher.name.lower(), e)
+    await db_pool.close()
+    logger.info("🔌 DB pool closed")
+
+def build_application(token=TOKEN, base_url=None):
+    """Create the Application with every handler registered.
+
+    `base_url` points the bot at another Bot API server (e.g. a local stub
+    for benchmarks).
+    """
+    builder = (
+        Application.builder()
+        .token(token)
+        .request(TimedRequest(connection_pool_size=256))
+        .concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    app = builder.build()
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("leaderboard", leaderboard_command))
+    app.add_handler(CommandHandler("rank", rank_command))
+    app.add_handler(CallbackQueryHandler(leaderboard_page_callback, pattern=r"^lb:"))
+    app.add_handler(CommandHandler("invite", invite_command))
+    app.add_handler(CommandHandler("inviters", inviters_command))
+    app.add_handler(CommandHandler("boosts", boosts_command))
+    app.add_handler(CommandHandler("cheaters", cheaters_command))
+    app.add_handler(CommandHandler("farms", farms_command))
+    app.add_handler(CommandHandler("reset_all", reset_all_command))
+    app.add_handler(CommandHandler("debug", debug_command))
+    app.add_handler(CommandHandler("stats", stats_command))
+    app.add_handler(CommandHandler("broadcast", broadcast_command))
+    app.add_handler(MessageHandler(filters.StatusUpdate.WEB_APP_DATA, handle_webapp_data))
+    return app
 
 def main():
     port_env = os.getenv('PORT')
     
     logger.info("=" * 60)
     logger.info("🚀 BERT TAP BOT - WEBHOOK MODE (PRO)")
-    logger.info("🔍 DEBUG INFO:")
-    logger.info("  - PORT env var: %s (type: %s)", port_env, type(port_env))
-    logger.info("  - All env vars with 'PORT': %s", {k: v for k, v in os.environ.items() if 'PORT' in k.upper()})
     
     if port_env:
         actual_port = int(port_env)
@@ -497,19 +3498,14 @@ def main():
         logger.warning("  ⚠️  This may cause 404 errors!")
     
     logger.info("Webhook: %s", WEBHOOK_URL)
+    if MULTI_WORKER:
+        logger.info("👥 Multi-worker mode: %s workers", WORKERS)
     logger.info("=" * 60)
     
-    init_db()
+    global db_pool
+    db_pool = create_db_pool()
     
-    app = Application.builder().token(TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("leaderboard", leaderboard_command))
-    app.add_handler(CommandHandler("invite", invite_command))
-    app.add_handler(CommandHandler("boosts", boosts_command))
-    app.add_handler(CommandHandler("cheaters", cheaters_command))
-    app.add_handler(CommandHandler("reset_all", reset_all_command))
-    app.add_handler(CommandHandler("debug", debug_command))
-    app.add_handler(MessageHandler(filters.StatusUpdate.WEB_APP_DATA, handle_webapp_data))
+    app = build_application()
     
     webhook_url = WEBHOOK_URL + "/" + TOKEN
     
@@ -523,7 +3519,8 @@ def main():
         port=actual_port,
         url_path=TOKEN,
         webhook_url=webhook_url,
-        allowed_updates=Update.ALL_TYPES
+        allowed_updates=Update.ALL_TYPES,
+        max_connections=WEBHOOK_MAX_CONNECTIONS
     )
 
 if __name__ == '__main__':